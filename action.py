@@ -59,9 +59,8 @@ class Advance(Action):
         delta_x, delta_y = gamemap.orientation_to_delta[gameboard.PC.orientation]
         to_x, to_y = x+delta_x, y+delta_y
         if gameboard.gamemap.is_passable((to_x,to_y)):
-            gameboard.gamemap.objects[gameboard.PC.coords].remove(gameboard.PC)
+            gameboard.gamemap.move_object(gameboard.PC, gameboard.PC.coords, (to_x,to_y))
             gameboard.PC.coords = to_x, to_y
-            gameboard.gamemap.objects[gameboard.PC.coords].append(gameboard.PC)
         else:
             raise ActionFailure("Cannot advance into (%i,%i): blocked by terrain"
                 % (to_x, to_y))
@@ -78,7 +77,7 @@ class OpenDoor(Action):
         if self.door.locked:
             raise ActionFailure("Door is locked")
         if self.door.closed:
-            self.door.closed = False
+            gameboard.gamemap.set_door_closed(self.coords, self.door, False)
         else:
             raise ActionFailure("Door is already open")
 
@@ -92,7 +91,7 @@ class CloseDoor(Action):
         if not gamemap.adjacent(self.subj.coords, self.coords):
             raise ActionFailure("Not adjacent to door")
         if not self.door.closed:
-            self.door.closed = True
+            gameboard.gamemap.set_door_closed(self.coords, self.door, True)
         else:
             raise ActionFailure("Door is already closed")
 
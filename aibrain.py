@@ -25,6 +25,10 @@ import random
 import action
 
 class Actor(object):
+    # Actors look where they are facing, and not very far
+    orientation = 0
+    sight_radius = 10
+    vision_cone = True
     
     def next(self):
         return None
@@ -0,0 +1,407 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2012 Anne Archibald <peridot.faceted@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#
+#
+
+import collections
+import zlib
+import base64
+
+import numpy as np
+
+import fov
+import gamemap
+
+class Chunk(object):
+    """One square block of terrain ids with its passable and opaque layers."""
+    def __init__(self, terrain_array, passable, opaque):
+        self.terrain_array = terrain_array
+        self.passable = passable
+        self.opaque = opaque
+        self.dirty = False
+
+class ChunkedMap(gamemap.Map):
+    """A Map whose terrain is stored in chunks created on demand.
+
+    The map is divided into chunk_size by chunk_size blocks. A block
+    is only materialized when something reads or writes it, and at
+    most max_chunks blocks are kept in memory; the least recently used
+    ones are evicted. Evicted blocks that have been modified are kept
+    compressed, while unmodified ones are simply regenerated when they
+    are next needed.
+
+    Fresh blocks are filled by generator(rect), where rect is
+    (x, y, w, h); it should return a pair (terrain_types, ids) giving
+    a list of Terrain objects and a w by h integer array of indices
+    into that list. The generator must be deterministic, since clean
+    blocks may be regenerated at any time. Without a generator, fresh
+    blocks are void.
+
+    The terrain(), set_terrain(), is_passable(), is_opaque() and
+    objects interface is the same as for Map; there are no whole-map
+    arrays, but region() assembles the layers for any rectangle.
+    Objects are stored sparsely for the whole map and are never
+    evicted.
+    """
+    yaml_tag = "!ChunkedMap"
+
+    def __init__(self, size, chunk_size=64, generator=None, max_chunks=256,
+                 view_radius=None):
+        self.size = size
+        self.w, self.h = self.size
+        self.chunk_size = chunk_size
+        self.generator = generator
+        self.max_chunks = max_chunks
+        if view_radius is None:
+            view_radius = chunk_size
+        self.view_radius = view_radius
+        self._init_palette()
+        self.terrain_dtype = np.uint8
+        self.objects = gamemap.ObjectLayer()
+        self.chunks = collections.OrderedDict()
+        self.stored = {}
+        # Terrain replaced by remap_terrain, for chunks not yet made
+        self.remapped = {}
+
+    def _set_terrain_dtype(self, dtype):
+        # Loaded chunks are widened now, stored ones when they come back
+        self.terrain_dtype = dtype
+        for c in self.chunks.values():
+            c.terrain_array = c.terrain_array.astype(dtype)
+
+    def compact_terrain_types(self):
+        """Drop palette entries no chunk uses and renumber the rest.
+
+        Loaded and stored chunks are scanned and renumbered; chunks
+        that will be regenerated put their terrain back in the
+        palette when they are loaded."""
+        used = np.zeros(len(self.terrain_types), bool)
+        stored = dict((key, self._unpack(key)) for key in self.stored)
+        for ids in [c.terrain_array for c in self.chunks.values()] + stored.values():
+            used[np.unique(ids)] = True
+        lut, kept = gamemap.compaction_table(self.terrain_types, used)
+        removed = len(self.terrain_types) - len(kept)
+        for c in self.chunks.values():
+            c.terrain_array = lut[c.terrain_array]
+        for key, ids in stored.items():
+            self.stored[key] = self._pack(lut[ids])
+        self._set_palette(kept)
+        self.terrain_dtype = lut.dtype.type
+        return removed
+
+    def chunk_rect(self, key):
+        ci, cj = key
+        x, y = ci*self.chunk_size, cj*self.chunk_size
+        return x, y, min(self.chunk_size, self.w-x), min(self.chunk_size, self.h-y)
+
+    def chunk(self, key):
+        """Return the chunk with index key, loading it if necessary."""
+        c = self.chunks.pop(key, None)
+        if c is None:
+            c = self._load(key)
+            while len(self.chunks) >= self.max_chunks:
+                self._evict(*self.chunks.popitem(last=False))
+        self.chunks[key] = c
+        return c
+
+    def _locate(self, xy):
+        i, j = xy
+        if not (0 <= i < self.w and 0 <= j < self.h):
+            raise IndexError("(%d,%d) is outside the map" % (i,j))
+        ci, li = divmod(i, self.chunk_size)
+        cj, lj = divmod(j, self.chunk_size)
+        return self.chunk((ci,cj)), (li,lj)
+
+    def _load(self, key):
+        x, y, w, h = rect = self.chunk_rect(key)
+        if key in self.stored:
+            ids = self._unpack(key).astype(self.terrain_dtype)
+        elif self.generator is not None:
+            types, gen_ids = self.generator(rect)
+            types = [self.remapped.get(t, t) for t in types]
+            lut = np.array([self.terrain_id(t) for t in types], self.terrain_dtype)
+            ids = lut[gen_ids]
+        else:
+            ids = np.zeros((w,h), self.terrain_dtype)
+        c = Chunk(ids, self.terrain_passable[ids], self.terrain_opaque[ids])
+        for (i,j), l in self.objects.in_rect(rect):
+            c.passable[i-x,j-y], c.opaque[i-x,j-y] = self._overlay((i,j),
+                c.passable[i-x,j-y], c.opaque[i-x,j-y])
+        return c
+
+    def _pack(self, ids):
+        return ids.dtype.str, zlib.compress(ids.tostring())
+    def _unpack(self, key):
+        dtype, data = self.stored[key]
+        x, y, w, h = self.chunk_rect(key)
+        return np.fromstring(zlib.decompress(data), dtype).reshape((w,h))
+
+    def _evict(self, key, c):
+        if c.dirty:
+            self.stored[key] = self._pack(c.terrain_array)
+
+    def flush(self):
+        """Compress all modified chunks into the chunk store."""
+        for key, c in self.chunks.items():
+            self._evict(key, c)
+            c.dirty = False
+
+    def preload(self, rect):
+        """Make sure the chunks covering rect are in memory."""
+        x, y, w, h = rect
+        s = self.chunk_size
+        for ci in range(max(x,0)//s, (min(x+w,self.w)-1)//s+1):
+            for cj in range(max(y,0)//s, (min(y+h,self.h)-1)//s+1):
+                self.chunk((ci,cj))
+
+    def terrain(self, xy):
+        c, ij = self._locate(xy)
+        return self.terrain_types[c.terrain_array[ij]]
+
+    def terrain_ids(self, coords):
+        xs, ys = coords
+        x0, y0 = xs.min(), ys.min()
+        ids = self.region((x0, y0, xs.max()-x0+1, ys.max()-y0+1))[0]
+        return ids[xs-x0, ys-y0]
+
+    def set_terrain(self, xy, t):
+        tid = self.terrain_id(t)
+        c, ij = self._locate(xy)
+        self._log_terrain((xy[0], xy[1], 1, 1))
+        c.terrain_array[ij] = tid
+        c.dirty = True
+        self.update_cell(xy)
+
+    def _write_terrain(self, rect, ids):
+        ids = np.asarray(ids)
+        x, y, w, h = rect
+        self._log_terrain(rect)
+        s = self.chunk_size
+        for ci in range(x//s, (x+w-1)//s+1):
+            for cj in range(y//s, (y+h-1)//s+1):
+                cx, cy, cw, ch = self.chunk_rect((ci,cj))
+                x0, x1 = max(x,cx), min(x+w,cx+cw)
+                y0, y1 = max(y,cy), min(y+h,cy+ch)
+                c = self.chunk((ci,cj))
+                dst = np.s_[x0-cx:x1-cx, y0-cy:y1-cy]
+                c.terrain_array[dst] = ids if ids.ndim == 0 else \
+                    ids[x0-x:x1-x, y0-y:y1-y]
+                part = c.terrain_array[dst]
+                c.passable[dst] = self.terrain_passable[part]
+                c.opaque[dst] = self.terrain_opaque[part]
+                c.dirty = True
+        for xy, l in self.objects.in_rect(rect):
+            self.update_cell(xy)
+        self._changed(rect)
+
+    def remap_terrain(self, mapping):
+        """Replace terrain throughout the map according to mapping.
+
+        Loaded and stored chunks are rewritten chunk by chunk, and
+        chunks generated later have mapping applied as they are made,
+        so the whole map counts as changed. Undoing the remap makes
+        the chunks generated since it again."""
+        lut = np.arange(len(self.terrain_types))
+        for old, new in mapping.items():
+            if old in self.terrain_types_reverse:
+                lut[self.terrain_types_reverse[old]] = self.terrain_id(new)
+        keys = set(self.chunks) | set(self.stored)
+        for key in keys:
+            rect = self.chunk_rect(key)
+            self._write_terrain(rect, lut[self.region(rect)[0]])
+        remapped = dict((t, mapping.get(n, n)) for (t, n) in self.remapped.items())
+        for old, new in mapping.items():
+            remapped.setdefault(old, new)
+        self._set_remapped(remapped, keys)
+
+    def _set_remapped(self, remapped, keys):
+        # Chunks yet to be made may come out differently anywhere
+        rect = (0, 0, self.w, self.h)
+        self._log('remapped', rect, frozenset(keys), self.remapped)
+        self.remapped = remapped
+        self._changed(rect)
+
+    def _undo_change(self, c):
+        if c.kind != 'remapped':
+            return gamemap.Map._undo_change(self, c)
+        # Everything since the remap has been undone, so the chunks
+        # made since are just as the generator made them; drop them
+        # to be made again without the remapping
+        for key in list(self.chunks):
+            if key not in c.obj:
+                del self.chunks[key]
+        for key in list(self.stored):
+            if key not in c.obj:
+                del self.stored[key]
+        self._set_remapped(c.before, set(self.chunks) | set(self.stored))
+
+    def _log_terrain(self, rect):
+        if self.journal is not None:
+            self.journal.record('terrain', rect, None,
+                                (self.region(rect)[0], self.terrain_types))
+
+    def update_cell(self, xy):
+        c, ij = self._locate(xy)
+        t = c.terrain_array[ij]
+        was_passable, was_opaque = c.passable[ij], c.opaque[ij]
+        c.passable[ij], c.opaque[ij] = self._overlay(xy,
+            self.terrain_passable[t], self.terrain_opaque[t])
+        self._changed((xy[0], xy[1], 1, 1), c.opaque[ij] != was_opaque,
+                      c.passable[ij] != was_passable)
+
+    def is_opaque(self, ij):
+        c, ij = self._locate(ij)
+        return c.opaque[ij]
+    def is_passable(self, ij):
+        c, ij = self._locate(ij)
+        return c.passable[ij]
+
+    def region(self, rect):
+        """Return (terrain ids, passable, opaque) arrays for rect."""
+        x, y, w, h = rect
+        ids = np.zeros((w,h), self.terrain_dtype)
+        passable = np.zeros((w,h), bool)
+        opaque = np.zeros((w,h), bool)
+        s = self.chunk_size
+        for ci in range(x//s, (x+w-1)//s+1):
+            for cj in range(y//s, (y+h-1)//s+1):
+                cx, cy, cw, ch = self.chunk_rect((ci,cj))
+                x0, x1 = max(x,cx), min(x+w,cx+cw)
+                y0, y1 = max(y,cy), min(y+h,cy+ch)
+                c = self.chunk((ci,cj))
+                src = np.s_[x0-cx:x1-cx, y0-cy:y1-cy]
+                dst = np.s_[x0-x:x1-x, y0-y:y1-y]
+                ids[dst] = c.terrain_array[src]
+                passable[dst] = c.passable[src]
+                opaque[dst] = c.opaque[src]
+        return ids, passable, opaque
+
+    def look(self, char, radius=None, compact=False):
+        if radius is None:
+            radius = getattr(char, 'sight_radius', None)
+        if radius is None:
+            radius = self.view_radius
+        return gamemap.Map.look(self, char, radius, compact)
+    def planning_rect(self, a, b):
+        # Paths are looked for within view_radius of the box holding
+        # both ends, so planning never has to load the whole map
+        r = self.view_radius
+        x0, x1 = min(a[0], b[0])-r, max(a[0], b[0])+r+1
+        y0, y1 = min(a[1], b[1])-r, max(a[1], b[1])+r+1
+        return self.clip_rect((x0, y0, x1-x0, y1-y0))
+    def _line_of_sight(self, a, b, radius):
+        if radius is None:
+            radius = self.view_radius
+        x, y = a
+        x0, y0, w, h = self.clip_rect((x-radius, y-radius, 2*radius+1, 2*radius+1))
+        ids, passable, opaque = self.region((x0, y0, w, h))
+        return fov.lineOfSight(opaque, x-x0, y-y0, b[0]-x0, b[1]-y0, radius)
+    def _lines_of_sight(self, pairs, radius):
+        return np.array([self._line_of_sight(a, b, radius) for (a, b) in pairs], bool)
+
+    def __str__(self):
+        return "ChunkedMap {0} by {1}: {2} chunks loaded, {3} stored".format(
+            self.w, self.h, len(self.chunks), len(self.stored))
+
+    def __getstate__(self):
+        self.flush()
+        d = self.__dict__.copy()
+        for k in ['w', 'h', 'chunks', 'stored', 'objects', 'terrain_types_reverse',
+                  'terrain_passable', 'terrain_opaque', 'terrain_dtype']:
+            del d[k]
+        for k in self._transient_state:
+            d.pop(k, None)
+        d['size'] = list(self.size)
+        d['stored_chunks'] = [[list(key), dtype, base64.b64encode(data)]
+                              for (key, (dtype, data)) in self.stored.items()]
+        d['objects'] = [[list(xy)]+list(l) for (xy, l) in self.objects.items()]
+        d['remapped'] = [[old, new] for (old, new) in self.remapped.items()]
+        return d
+    def __setstate__(self, d):
+        terrain_types = d.pop('terrain_types')
+        stored = d.pop('stored_chunks')
+        objects = d.pop('objects')
+        remapped = d.pop('remapped', [])
+        self.__dict__ = d
+        self.remapped = dict((old, new) for (old, new) in remapped)
+        self.size = tuple(self.size)
+        self.w, self.h = self.size
+        self._init_palette()
+        self.terrain_dtype = np.uint8
+        for t in terrain_types[1:]:
+            self.add_terrain_type(t)
+        self.chunks = collections.OrderedDict()
+        self.stored = dict((tuple(key), (dtype, base64.b64decode(data)))
+                           for (key, dtype, data) in stored)
+        self.objects = gamemap.ObjectLayer()
+        for l in objects:
+            for o in l[1:]:
+                self.objects.add(tuple(l[0]), o)
+
+if __name__=='__main__':
+    import terrain
+    def overland(rect):
+        x, y, w, h = rect
+        i, j = np.ogrid[x:x+w, y:y+h]
+        return [terrain.floor, terrain.wall], ((i*7+j*13) % 23 == 0).astype(np.uint8)
+    M = ChunkedMap((10000,10000), generator=overland, max_chunks=64)
+    for k in range(0, 10000, 50):
+        M.set_terrain((k,k), terrain.wall)
+    print M
+    print M.terrain((5000,5000)).name, M.is_passable((5001,5000))
+
+    # Bulk writes and their undoing come out the same as on a Map
+    size = (150, 130)
+    A, B = gamemap.Map(size), ChunkedMap(size, chunk_size=32, max_chunks=4)
+    door = terrain.Terrain("door", "+", None)
+    small = gamemap.Map((40, 40))
+    small.fill_rect((5, 5, 30, 30), terrain.wall)
+    small.fill_rect((10, 10, 20, 20), terrain.floor)
+    mask = np.zeros(size, bool)
+    mask[::7, 3::5] = True
+    for m in [A, B]:
+        m.fill_rect((-10, 20, 100, 50), terrain.floor)
+        v = m.start_journal().version
+        m.set_terrain_mask(mask, terrain.wall)
+        m.stamp((100, 90), small, transparent=terrain.void)
+        m.remap_terrain({terrain.wall: door})
+        m.undo(v + 2)
+    for m in [A, B]:
+        m.fill_rect((60, 0, 3, 130), terrain.wall)
+    ids, passable, opaque = B.region((0, 0) + size)
+    assert (np.array(A.terrain_types)[A.terrain_array] ==
+            np.array(B.terrain_types)[ids]).all()
+    assert (A.passable == passable).all() and (A.opaque == opaque).all()
+    print "bulk writes agree with a Map"
+
+    # Remapping reaches chunks made later, and undoing it puts them back
+    G = ChunkedMap((256, 256), chunk_size=32, generator=overland, max_chunks=4)
+    class Viewer(object):
+        coords = (8, 8)
+    seen = len(G.look(Viewer, 5))
+    for xy in [(100, 100), (200, 200), (150, 30), (30, 150)]:
+        G.terrain(xy)
+    v = G.start_journal().version
+    G.remap_terrain({terrain.floor: terrain.wall})
+    assert G.terrain((9, 8)) == terrain.wall and len(G.look(Viewer, 5)) < seen
+    G.fill_rect((0, 0, 20, 20), terrain.floor)
+    G.undo(v)
+    assert G.terrain((9, 8)) == terrain.floor and len(G.look(Viewer, 5)) == seen
+    print "remapping and its undo reach chunks made later"
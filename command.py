@@ -24,6 +24,7 @@ import collections
 
 import action
 import gamemap
+import pathfind
         
 class Command(object):
     """A command is something the player asks the game to do.
@@ -58,13 +59,40 @@ def TurnAndGo(PC, orientation):
         yield action.Turn(d>0)
     yield action.Advance()
 
+def _in_the_way(PC, current_map, xy):
+    """Whether something stops PC from stepping onto xy."""
+    return not current_map.is_passable(xy) or any(
+        gamemap.object_kind(o) == 'actors' and o is not PC
+        for o in current_map.objects[xy])
+
 @command_wrapper
 def GoTo(PC,current_map,coords):
+    # The path is planned once and followed; it is only repaired when
+    # the map's passability changes or the next step is in the way.
+    # The planner sees the map's planning_rect, with its own origin.
+    x0, y0, w, h = rect = current_map.planning_rect(PC.coords, coords)
+    def layers():
+        return (current_map.region(rect)[1],
+                current_map.occupied(ignore=[PC], rect=rect))
+    passable, blocked = layers()
+    planner = pathfind.DStarLite(passable, (coords[0]-x0, coords[1]-y0), blocked)
+    version = current_map.passability_version
+    p = None
     while True:
-        try:
-            p, d = gamemap.find_path(PC.coords, coords, lambda x,y: current_map.is_passable((x,y)))
-        except gamemap.NoPathException, e:
-            p, d = e.best_effort
+        if p is not None and len(p)>1 and p[1] == PC.coords:
+            p = p[1:]
+        stale = version != current_map.passability_version
+        if p is not None and len(p)>1 and not stale:
+            stale = _in_the_way(PC, current_map, p[1])
+        if stale:
+            planner.update(*layers())
+            version = current_map.passability_version
+        if stale or p is None or p[0] != PC.coords:
+            try:
+                p, d = planner.path((PC.coords[0]-x0, PC.coords[1]-y0))
+            except gamemap.NoPathException, e:
+                p, d = e.best_effort
+            p = [(x+x0, y+y0) for (x, y) in p]
         if len(p)>1:
             c, n = p[:2]
             o = gamemap.find_orientation(c,n)
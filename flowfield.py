@@ -0,0 +1,233 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2012 Anne Archibald <peridot.faceted@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#
+#
+
+"""Distance fields ("Dijkstra maps") for moving many actors at once.
+
+A distance field gives, for every cell, the length of the shortest
+path from it to the nearest of some source cells, with the same step
+costs as pathfind (1 along an axis, sqrt(2) diagonally); cells that
+cannot reach a source are infinite. An actor heads for the sources by
+stepping downhill, so one field serves every actor chasing the same
+target.
+
+A flee field is made from a distance field by scaling it by a negative
+factor and letting it settle again; stepping downhill on it leads away
+from the sources, but around them to open ground rather than into the
+nearest dead end.
+
+Fields are worked out by relaxing every cell against its neighbours
+with whole-array operations until nothing changes, looking only at the
+area where something changed on the last pass.
+"""
+
+import collections
+
+import numpy as np
+
+from pathfind import steps
+
+FLEE_FACTOR = -1.2
+
+def relax(passable, field):
+    """Lower field in place until no passable cell can do better by
+    stepping to a neighbour. Returns field.
+
+    Cells that are not passable keep their values."""
+    passable = np.asarray(passable, bool)
+    w, h = field.shape
+    # Padded with infinity, so neighbours can be read as shifted slices
+    f = np.empty((w+2, h+2), field.dtype)
+    f[...] = np.inf
+    f[1:-1, 1:-1] = field
+    xs, ys = np.nonzero(np.isfinite(field))
+    if len(xs) == 0:
+        return field
+    x0, x1, y0, y1 = xs.min()-1, xs.max()+2, ys.min()-1, ys.max()+2
+    while True:
+        x0, x1, y0, y1 = max(x0, 0), min(x1, w), max(y0, 0), min(y1, h)
+        cur = f[1+x0:1+x1, 1+y0:1+y1]
+        best = cur.copy()
+        for dx, dy, c in steps:
+            np.minimum(best, f[1+x0+dx:1+x1+dx, 1+y0+dy:1+y1+dy] + c, best)
+        better = (best < cur) & passable[x0:x1, y0:y1]
+        xs, ys = np.nonzero(better)
+        if len(xs) == 0:
+            break
+        cur[better] = best[better]
+        x0, x1, y0, y1 = x0+xs.min()-1, x0+xs.max()+2, y0+ys.min()-1, y0+ys.max()+2
+    field[...] = f[1:-1, 1:-1]
+    return field
+
+def distance_field(passable, sources, radius=None):
+    """Distance from each cell to the nearest of the cells sources.
+
+    With a radius, only distances up to radius are worked out and
+    everything further is infinite; the work is then bounded by the
+    area within radius of the sources."""
+    passable = np.asarray(passable, bool)
+    w, h = passable.shape
+    field = np.empty((w, h))
+    field[...] = np.inf
+    sources = [tuple(s) for s in sources]
+    if not sources:
+        return field
+    if radius is None:
+        x0, y0, x1, y1 = 0, 0, w, h
+    else:
+        # A path longer than radius cannot get further than this
+        xs, ys = zip(*sources)
+        x0, x1 = max(min(xs)-radius, 0), min(max(xs)+radius+1, w)
+        y0, y1 = max(min(ys)-radius, 0), min(max(ys)+radius+1, h)
+    sub = field[x0:x1, y0:y1]
+    for x, y in sources:
+        sub[x-x0, y-y0] = 0
+    relax(passable[x0:x1, y0:y1], sub)
+    if radius is not None:
+        sub[sub > radius] = np.inf
+    return field
+
+def flee_field(passable, distance, factor=FLEE_FACTOR):
+    """A field for getting away from the sources of a distance field.
+
+    factor should be negative; the further below -1 it is, the more an
+    actor will risk passing close to the sources to reach open ground."""
+    field = distance * factor
+    field[~np.isfinite(distance)] = np.inf
+    return relax(passable, field)
+
+def downhill(field, xy):
+    """The neighbour of xy with the lowest value in field, if it is
+    lower than xy's own; otherwise None."""
+    w, h = field.shape
+    x, y = xy
+    best, step = field[x, y], None
+    for dx, dy, c in steps:
+        nx, ny = x+dx, y+dy
+        if 0 <= nx < w and 0 <= ny < h and field[nx, ny] < best:
+            best, step = field[nx, ny], (nx, ny)
+    return step
+
+class FlowFields(object):
+    """Distance and flee fields over a Map, worked out when first asked for.
+
+    Fields are kept, keyed by their sources and radius, until the
+    map's passability changes (as shown by its passability_version);
+    at most max_entries are kept, the least recently used going
+    first. The arrays are shared and must not be modified.
+
+    The fields cover the whole map, so this needs a Map with whole-map
+    layers; a ChunkedMap has none and is refused.
+    """
+    def __init__(self, map, max_entries=16):
+        if not hasattr(map, 'passable'):
+            raise TypeError("FlowFields needs a map with a whole-map passable layer")
+        self.map = map
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.version = map.passability_version
+        self.hits = self.misses = 0
+
+    def _get(self, key, make):
+        if self.version != self.map.passability_version:
+            self.entries.clear()
+            self.version = self.map.passability_version
+        f = self.entries.pop(key, None)
+        if f is None:
+            self.misses += 1
+            f = make()
+        else:
+            self.hits += 1
+        self.entries[key] = f
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return f
+
+    def distance(self, sources, radius=None):
+        """Distance to the nearest of sources; see distance_field."""
+        sources = frozenset(tuple(s) for s in sources)
+        return self._get(('distance', sources, radius),
+            lambda: distance_field(self.map.passable, sources, radius))
+    def flee(self, sources, radius=None, factor=FLEE_FACTOR):
+        """Field for fleeing from sources; see flee_field."""
+        sources = frozenset(tuple(s) for s in sources)
+        return self._get(('flee', sources, radius, factor),
+            lambda: flee_field(self.map.passable,
+                               self.distance(sources, radius), factor))
+
+if __name__=='__main__':
+    import time
+    import random
+    import util
+    import gamemap
+    import pathfind
+
+    random.seed(0)
+    M = gamemap.load_ascii_map(util.data_dir("testmap2.txt"))
+    passable = M.passable
+    cells = zip(*[a.tolist() for a in np.nonzero(passable)])
+
+    # The field agrees with A* from every cell
+    goal = random.choice(cells)
+    field = distance_field(passable, [goal])
+    for c in random.sample(cells, 50):
+        try:
+            l = pathfind.find_path(c, goal, passable)[1]
+        except pathfind.NoPathException:
+            l = np.inf
+        assert field[c] == l or abs(field[c] - l) < 1e-9
+
+    # Many actors chasing one target, for a number of turns
+    actors = random.sample(cells, 40)
+    turns = 10
+    t = time.time()
+    for k in range(turns):
+        for a in actors:
+            try:
+                pathfind.find_path(a, goal, passable)
+            except pathfind.NoPathException:
+                pass
+    tastar = (time.time() - t) / turns
+    F = FlowFields(M)
+    t = time.time()
+    for k in range(turns):
+        f = F.distance([goal])
+        steps_taken = [downhill(f, a) for a in actors]
+    tfield = (time.time() - t) / turns
+    print "%d actors chasing one target on testmap2:" % len(actors)
+    print "  one A* each:      %.2f ms per turn" % (1000 * tastar)
+    print "  one flow field:   %.2f ms per turn (%d fields worked out)" % \
+        (1000 * tfield, F.misses)
+
+    for radius in [None, 10]:
+        t = time.time()
+        distance_field(passable, [goal], radius)
+        print "  field of radius %s: %.2f ms" % (radius, 1000 * (time.time() - t))
+
+    # Fleeing actors end up further away
+    flee = F.flee([goal])
+    a = min(cells, key=lambda c: abs(field[c] - 3))
+    for k in range(20):
+        n = downhill(flee, a)
+        if n is None:
+            break
+        a = n
+    print "  an actor starting 3 away flees to %.1f away" % field[a]
@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2012 Anne Archibald <peridot.faceted@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#
+#
+
+"""Compare the field of view algorithms in fov.algorithms.
+
+For each test map, every algorithm is run from the same observers and
+its visible sets are compared with those of a reference algorithm
+(precise permissive by default). Run this file to get a table for the
+test maps in the data directory and a few generated ones.
+"""
+
+import time
+
+import numpy as np
+
+import fov
+
+def standard_maps():
+    """List (name, opaque) for the test maps."""
+    import util
+    import gamemap
+    maps = []
+    for f in ["testmap1.txt", "testmap2.txt"]:
+        maps.append((f, gamemap.load_ascii_map(util.data_dir(f)).opaque))
+    rs = np.random.RandomState(0)
+    arena = np.zeros((120, 120), bool)
+    arena[[0,-1],:] = arena[:,[0,-1]] = True
+    maps.append(("open arena 120x120", arena))
+    maps.append(("pillars 120x120", arena | (rs.rand(120, 120) < 0.05)))
+    maps.append(("rubble 120x120", arena | (rs.rand(120, 120) < 0.3)))
+    return maps
+
+def observers(opaque, n, radius, seed=0):
+    """n random observers (x, y, radius) standing on clear cells."""
+    xs, ys = np.nonzero(~opaque)
+    k = np.random.RandomState(seed).randint(len(xs), size=n)
+    return [(xs[i], ys[i], radius) for i in k]
+
+def compare(opaque, obs, algorithms=None, reference='permissive'):
+    """Run each algorithm from each observer and compare with reference.
+
+    Returns a dictionary from algorithm name to a dictionary of
+    statistics: 'views' and 'tiles' per second (tiles counts the
+    visible cells produced), 'differ' the number of observers whose
+    visible set is not the reference's, and 'extra' and 'missing' the
+    mean number of cells per observer seen only by this algorithm or
+    only by the reference."""
+    if algorithms is None:
+        algorithms = fov.algorithms
+    masks = {}
+    stats = {}
+    for name in sorted(algorithms):
+        f = algorithms[name]
+        t = time.time()
+        masks[name] = [f(opaque, x, y, r) for (x, y, r) in obs]
+        t = time.time() - t
+        tiles = sum(m.sum() for m in masks[name])
+        stats[name] = {'views': len(obs)/t, 'tiles': tiles/t}
+    for name in stats:
+        extra = missing = differ = 0
+        for m, ref in zip(masks[name], masks[reference]):
+            e, s = (m & ~ref).sum(), (ref & ~m).sum()
+            extra += e
+            missing += s
+            differ += bool(e or s)
+        stats[name].update(differ=differ, extra=float(extra)/len(obs),
+                           missing=float(missing)/len(obs))
+    return stats
+
+def report(maps, n=100, radius=20, reference='permissive'):
+    for name, opaque in maps:
+        obs = observers(opaque, n, radius)
+        stats = compare(opaque, obs, reference=reference)
+        print "%s (%dx%d), %d observers, radius %d" % ((name,) + opaque.shape + (n, radius))
+        print "  %-14s %9s %11s %7s %8s %8s" % ("algorithm", "views/s", "tiles/s",
+                                               "differ", "extra", "missing")
+        for alg in sorted(stats):
+            s = stats[alg]
+            print "  %-14s %9.0f %11.0f %7d %8.2f %8.2f" % (alg, s['views'], s['tiles'],
+                s['differ'], s['extra'], s['missing'])
+
+if __name__=='__main__':
+    report(standard_maps())
@@ -0,0 +1,137 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2012 Anne Archibald <peridot.faceted@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#
+#
+
+"""Fields of view for many observers at once, on a pool of processes.
+
+An FOVPool copies a map's opaque layer into shared memory and starts
+worker processes that read it from there, so the map is never pickled.
+Each observer's view comes back as a bitset covering just the box it
+can reach, which keeps the traffic between processes small.
+"""
+
+import multiprocessing
+import multiprocessing.sharedctypes
+
+import numpy as np
+
+import fov
+
+# The shared opaque layer, as seen by a worker process
+_opaque = None
+
+def _init_worker(buf, shape):
+    global _opaque
+    _opaque = np.frombuffer(buf, bool).reshape(shape)
+
+def reach(shape, x, y, radius):
+    """The box (x0, y0, w, h) a view from (x, y) can reach."""
+    w, h = shape
+    x0, y0 = max(x-radius, 0), max(y-radius, 0)
+    return x0, y0, min(x+radius+1, w)-x0, min(y+radius+1, h)-y0
+
+def view_bits(opaque, x, y, radius):
+    """Field of view from (x, y) as (box, packed bits of the box)."""
+    x0, y0, w, h = box = reach(opaque.shape, x, y, radius)
+    # The box is exactly what the scan can reach, so scanning just the
+    # box gives the same cells as scanning the whole map
+    mask = fov.fieldOfViewMask(opaque[x0:x0+w, y0:y0+h], x-x0, y-y0, radius)
+    return box, np.packbits(mask, axis=None).tostring()
+
+def _view_bits(observer):
+    return view_bits(_opaque, *observer)
+
+def unpack(shape, bits):
+    """Turn (box, bits) from bitsets back into a mask of the given shape."""
+    (x0, y0, w, h), data = bits
+    mask = np.zeros(shape, bool)
+    packed = np.frombuffer(data, np.uint8)
+    mask[x0:x0+w, y0:y0+h] = np.unpackbits(packed)[:w*h].reshape((w, h))
+    return mask
+
+class FOVPool(object):
+    """A pool of processes working out fields of view on one map.
+
+    opaque is the map's opaque layer; it is copied into shared memory
+    when the pool is made, and update copies in a new version (of the
+    same shape). Observers are given as (x, y, radius) triples.
+    """
+    def __init__(self, opaque, processes=None):
+        opaque = np.asarray(opaque, bool)
+        self.shape = opaque.shape
+        self.buf = multiprocessing.sharedctypes.RawArray('b', opaque.size)
+        self.opaque = np.frombuffer(self.buf, bool).reshape(self.shape)
+        self.opaque[...] = opaque
+        if processes is None:
+            processes = multiprocessing.cpu_count()
+        self.processes = processes
+        self.pool = multiprocessing.Pool(processes, _init_worker,
+                                         (self.buf, self.shape))
+
+    def update(self, opaque, rect=None):
+        """Copy opaque, or just the part inside rect, to the workers.
+
+        No views should be in progress while this happens."""
+        if rect is None:
+            self.opaque[...] = opaque
+        else:
+            x, y, w, h = rect
+            self.opaque[x:x+w, y:y+h] = opaque[x:x+w, y:y+h]
+
+    def bitsets(self, observers, chunksize=None):
+        """Fields of view as a list of (box, bits); see unpack."""
+        observers = [tuple(o) for o in observers]
+        if chunksize is None:
+            chunksize = max(1, len(observers)//(4*self.processes))
+        return self.pool.map(_view_bits, observers, chunksize)
+
+    def masks(self, observers, chunksize=None):
+        """Fields of view as a list of boolean masks the shape of the map."""
+        return [unpack(self.shape, b)
+                for b in self.bitsets(observers, chunksize)]
+
+    def close(self):
+        self.pool.close()
+        self.pool.join()
+
+if __name__=='__main__':
+    import time
+    import random
+
+    random.seed(0)
+    opaque = np.random.RandomState(0).rand(400, 400) < 0.1
+    observers = [(random.randrange(400), random.randrange(400), 20)
+                 for k in range(2000)]
+
+    t = time.time()
+    expected = [fov.fieldOfViewMask(opaque, *o) for o in observers]
+    serial = time.time() - t
+    print "%d observers, serial: %.0f views/s" % (len(observers), len(observers)/serial)
+
+    for processes in sorted(set([1, 2, 4, multiprocessing.cpu_count()])):
+        P = FOVPool(opaque, processes)
+        t = time.time()
+        bits = P.bitsets(observers)
+        elapsed = time.time() - t
+        P.close()
+        assert all((unpack(opaque.shape, b) == m).all()
+                   for (b, m) in zip(bits, expected))
+        print "%d processes: %.0f views/s" % (processes, len(observers)/elapsed)
@@ -20,9 +20,9 @@
 #       
 #       
 
-import unicodedata
+import zlib
+import base64
 import collections
-import heapq
 
 import numpy as np
 import random
@@ -30,100 +30,634 @@ import random
 import util
 import yaml
 import fov
+from pathfind import NoPathException, find_path
 import terrain
 import image
 
-def unicode_usable(c):
-    if c in '\\ \t':
-        return False
-    if not unicodedata.category(c) in [
-            'Ll', 'Lt', 'Lu', 'Me', 'Nd', 'Nl', 'No', 
-            'Pc', 'Pd', 'Pe', 'Pf', 'Pi', 'Po', 'Ps',
-            'Sc', 'Sm']:
-        return False
-    return True
-usable_unicode_chars = [unichr(i) for i in range(65536) if unicode_usable(unichr(i))]
+def terrain_dtype(n):
+    """Smallest dtype for the terrain ids of a palette with n entries."""
+    if n < 256:
+        return np.uint8
+    elif n < 65536:
+        return np.uint16
+    else:
+        return np.uint32
+
+def compaction_table(terrain_types, used):
+    """Work out how to drop the unused entries of a palette.
+
+    used is a boolean array saying which palette ids occur. Returns
+    (lut, kept) where lut maps old ids to new ones (in the dtype the
+    compacted palette needs) and kept is the new palette. Entry 0,
+    the void, is always kept."""
+    used = np.array(used, bool)
+    used[0] = True
+    kept = [t for (t,u) in zip(terrain_types, used) if u]
+    lut = (np.cumsum(used)-1).astype(terrain_dtype(len(kept)))
+    return lut, kept
+
+def object_kind(obj):
+    """Name of the ObjectLayer index an object is filed under."""
+    if isinstance(obj, Door):
+        return 'doors'
+    elif isinstance(obj, Feature):
+        return 'features'
+    else:
+        return 'actors'
+
+class ObjectLayer(object):
+    """Sparse storage for the objects lying on a map.
+    
+    Only cells that actually contain something take up memory; looking
+    up an empty cell returns an empty tuple and stores nothing. Each
+    object is also filed by kind (see object_kind) along with its
+    coordinates, so that all the doors or all the actors on a map can
+    be found without scanning it. Features such as thin walls may be
+    shared between many cells, so an object can have several locations.
+
+    The lists returned by indexing must not be modified directly; use
+    add, remove and clear so the indexes stay consistent.
+    """
+    def __init__(self):
+        self.cells = {}
+        self.kinds = {'doors': {}, 'actors': {}, 'features': {}}
+
+    def __getitem__(self, xy):
+        return self.cells.get(xy, ())
+    def get(self, xy, default=()):
+        return self.cells.get(xy, default)
+    def __contains__(self, xy):
+        return xy in self.cells
+    def __len__(self):
+        return len(self.cells)
+    def __iter__(self):
+        return iter(self.cells)
+    def keys(self):
+        return self.cells.keys()
+    def values(self):
+        return self.cells.values()
+    def items(self):
+        return self.cells.items()
+
+    def add(self, xy, obj):
+        self.cells.setdefault(xy, []).append(obj)
+        self.kinds.setdefault(object_kind(obj), {}).setdefault(obj, []).append(xy)
+    def remove(self, xy, obj):
+        l = self.cells[xy]
+        l.remove(obj)
+        if not l:
+            del self.cells[xy]
+        self._unindex(xy, obj)
+    def clear(self, xy):
+        """Remove and return everything at xy."""
+        l = self.cells.pop(xy, [])
+        for obj in l:
+            self._unindex(xy, obj)
+        return l
+    def _unindex(self, xy, obj):
+        index = self.kinds[object_kind(obj)]
+        places = index[obj]
+        places.remove(xy)
+        if not places:
+            del index[obj]
+
+    def of_kind(self, kind):
+        """Yield (xy, obj) for every object of the given kind."""
+        for obj, places in self.kinds.get(kind, {}).items():
+            for xy in places:
+                yield xy, obj
+    def where(self, obj):
+        """Coordinates of obj, or None if it is not on the map."""
+        places = self.kinds.get(object_kind(obj), {}).get(obj)
+        if places:
+            return places[0]
+        return None
+
+    def in_rect(self, rect):
+        """Yield (xy, objects) for the nonempty cells inside rect.
+
+        rect is (x, y, w, h), as for a pygame Rect."""
+        x, y, w, h = rect
+        if w*h < len(self.cells):
+            for i in range(x, x+w):
+                for j in range(y, y+h):
+                    if (i,j) in self.cells:
+                        yield (i,j), self.cells[i,j]
+        else:
+            for (i,j), l in self.cells.items():
+                if x <= i < x+w and y <= j < y+h:
+                    yield (i,j), l
+
+
+# One entry in a Journal. kind is 'terrain', 'add', 'remove' or 'door',
+# or 'remapped' on a ChunkedMap. For 'terrain', where is a rect
+# (x, y, w, h) and before is a pair (ids, palette) holding the old
+# terrain ids and the palette they index. For 'remapped', where is the
+# whole map, obj the keys of the chunks made so far and before the old
+# remapping of terrain for chunks yet to be made. Otherwise where is a
+# cell and obj the object added, removed or (for 'door') opened or
+# closed, with before its old closed flag.
+Change = collections.namedtuple('Change', 'version kind where obj before')
+
+class Journal(object):
+    """Record of the changes made to a Map, numbered by version.
+
+    Each change bumps the version by one, so the changes made after
+    some point are the ones since the version noted then. This is
+    enough to save just what changed, to undo back to a version, or
+    to tell whether a cached result covering some area is stale.
+    Entries can be dropped with forget once nothing needs them.
+    """
+    def __init__(self, version=0):
+        self.version = version
+        self.entries = collections.deque()
+
+    def record(self, kind, where, obj=None, before=None):
+        self.version += 1
+        self.entries.append(Change(self.version, kind, where, obj, before))
+
+    @property
+    def oldest(self):
+        """The earliest version changes can still be listed since."""
+        return self.version - len(self.entries)
+
+    def since(self, version):
+        """List the changes made after version, oldest first."""
+        if version < self.oldest:
+            raise ValueError("Changes before version %d have been forgotten"
+                             % self.oldest)
+        n = self.version - version
+        return list(self.entries)[len(self.entries)-n:] if n>0 else []
+
+    def changed_cells(self, version):
+        """Set of the cells touched since version."""
+        cells = set()
+        for c in self.since(version):
+            if c.kind in ('terrain', 'remapped'):
+                x, y, w, h = c.where
+                cells.update((i,j) for i in range(x,x+w) for j in range(y,y+h))
+            else:
+                cells.add(c.where)
+        return cells
+
+    def changed_rect(self, version):
+        """Bounding rect (x, y, w, h) of the changes since version.
+
+        Returns None if nothing has changed."""
+        x0 = y0 = np.inf
+        x1 = y1 = -np.inf
+        for c in self.since(version):
+            if c.kind in ('terrain', 'remapped'):
+                x, y, w, h = c.where
+            else:
+                (x, y), w, h = c.where, 1, 1
+            x0, y0 = min(x0,x), min(y0,y)
+            x1, y1 = max(x1,x+w), max(y1,y+h)
+        if x0 == np.inf:
+            return None
+        return int(x0), int(y0), int(x1-x0), int(y1-y0)
+
+    def forget(self, version):
+        """Drop the entries up to and including version."""
+        while self.entries and self.entries[0].version <= version:
+            self.entries.popleft()
+
+
+# What Map.look(char, compact=True) returns. coords is the pair of
+# arrays (xs, ys) of visible cells, terrain the terrain id of each, as
+# an index into palette, and objects a list of (xy, obj) for the
+# objects on them.
+Sight = collections.namedtuple('Sight', 'coords terrain objects palette')
+
+def view_mask(opaque, xy, radius, algorithm, quadrants=None):
+    """Mask of the cells of the array opaque visible from xy.
+
+    algorithm names one of fov.algorithms. quadrants, as for
+    fov.fieldOfViewMask, lets permissive FOV look into only some
+    quadrants; the other algorithms always look into all of them."""
+    if algorithm == 'permissive':
+        return fov.fieldOfViewMask(opaque, xy[0], xy[1], radius, quadrants)
+    return fov.algorithms[algorithm](opaque, xy[0], xy[1], radius)
+
+class CachedView(object):
+    """A field of view remembered by an FOVCache.
+
+    rect is the bounding box (x0, y0, x1, y1) of the visible cells,
+    coords their coordinates (xs, ys), and things and sight what
+    Map.look builds from them, or None if they have not been built
+    yet."""
+    def __init__(self, coords, rect=None):
+        self.coords = coords
+        if rect is None:
+            xs, ys = coords
+            self.rect = xs.min(), ys.min(), xs.max()+1, ys.max()+1
+        else:
+            x, y, w, h = rect
+            self.rect = x, y, x+w, y+h
+        self.things = self.sight = None
+
+class FOVCache(object):
+    """Fields of view computed on a Map, kept until they go stale.
+
+    Entries are keyed by (origin, radius, algorithm, facing). With precise
+    permissive FOV what is visible only depends on the opacity of the
+    visible cells, so an entry is dropped only when opacity changes
+    inside the bounding box of its visible cells; any other change
+    there just drops the list of things seen. At most max_entries are
+    kept, the least recently used going first.
+    """
+    def __init__(self, max_entries=64):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.hits = self.misses = 0
+
+    def get(self, key):
+        v = self.entries.pop(key, None)
+        if v is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self.entries[key] = v
+        return v
+    def put(self, key, coords, rect=None):
+        """Remember the visible cells coords under key.
+
+        By default the entry goes stale when opacity changes within
+        the bounding box of coords; rect (x, y, w, h) gives another
+        area to watch instead."""
+        v = self.entries[key] = CachedView(coords, rect)
+        while len(self.entries) > self.max_entries:
+            self.entries.popitem(last=False)
+        return v
+
+    def invalidate(self, rect, opacity=True):
+        """Note a change inside rect (x, y, w, h).
+
+        opacity says whether the change may have affected opacity."""
+        x, y, w, h = rect
+        for key, v in self.entries.items():
+            x0, y0, x1, y1 = v.rect
+            if x < x1 and x0 < x+w and y < y1 and y0 < y+h:
+                if opacity:
+                    del self.entries[key]
+                else:
+                    v.things = v.sight = None
+    def clear(self):
+        self.entries.clear()
 
 
 class Map(yaml.YAMLObject):
     yaml_tag = "!Map"
-    
+    # The change journal, if one has been started
+    journal = None
+    # Name of the field of view algorithm to use, from fov.algorithms
+    fov_algorithm = 'permissive'
+    # Fields of view already worked out, made when first needed
+    fov_cache = None
+    # The last field of view worked out for each radius, for updating
+    fov_trackers = None
+    # Answers from line_of_sight, made when first needed
+    los_cache = None
+    # Goes up whenever passability may have changed anywhere
+    passability_version = 0
+    # Attributes that are not saved with the map
+    _transient_state = ['journal', 'fov_cache', 'fov_trackers', 'los_cache',
+                        'passability_version']
+
     def __init__(self, size):
+        self._init_layers(size)
+
+    def _init_layers(self, size):
         self.size = size
         self.w, self.h = self.size
         self.terrain_array = np.zeros(self.size, np.uint8)
+        self._init_palette()
+        self.objects = ObjectLayer()
+        # Whole-map layers: terrain lookup plus the overlay from objects
+        self.passable = self.terrain_passable[self.terrain_array]
+        self.opaque = self.terrain_opaque[self.terrain_array]
+
+    def _init_palette(self):
         self.terrain_types = [terrain.void]
         self.terrain_types_reverse = { self.terrain_types[0]: 0 }
-        self.objects = collections.defaultdict(list)
+        # Per-terrain-id lookup tables for the passable and opaque layers
+        self.terrain_passable = np.array([terrain.void.passable], bool)
+        self.terrain_opaque = np.array([terrain.void.opaque], bool)
+
+    def _set_palette(self, terrain_types):
+        """Replace the palette wholesale, leaving terrain_array alone."""
+        self.terrain_types = list(terrain_types)
+        self.terrain_types_reverse = dict((t,i) for (i,t) in enumerate(self.terrain_types))
+        self.terrain_passable = np.array([t.passable for t in self.terrain_types], bool)
+        self.terrain_opaque = np.array([t.opaque for t in self.terrain_types], bool)
 
     def add_terrain_type(self, t):
         self.terrain_types.append(t)
         self.terrain_types_reverse[t] = len(self.terrain_types)-1
+        self.terrain_passable = np.append(self.terrain_passable, bool(t.passable))
+        self.terrain_opaque = np.append(self.terrain_opaque, bool(t.opaque))
         if len(self.terrain_types) == 256:
-            self.terrain_array = self.terrain_array.astype(np.uint16)
+            self._set_terrain_dtype(np.uint16)
         elif len(self.terrain_types) == 65536:
-            self.terrain_array = self.terrain_array.astype(np.uint32)
+            self._set_terrain_dtype(np.uint32)
+
+    def _set_terrain_dtype(self, dtype):
+        self.terrain_array = self.terrain_array.astype(dtype)
+
+    def compact_terrain_types(self):
+        """Drop palette entries no cell uses and renumber the rest.
+
+        The terrain array is renumbered in one pass and narrowed to
+        the smallest dtype that holds the remaining palette. Returns
+        the number of entries removed."""
+        used = np.bincount(self.terrain_array.ravel(),
+                           minlength=len(self.terrain_types)) > 0
+        lut, kept = compaction_table(self.terrain_types, used)
+        removed = len(self.terrain_types) - len(kept)
+        if removed or lut.dtype != self.terrain_array.dtype:
+            self.terrain_array = lut[self.terrain_array]
+            self._set_palette(kept)
+        return removed
                 
     def terrain(self, xy):
         return self.terrain_types[self.terrain_array[xy]]
         
-    def set_terrain(self, xy, t):
+    def terrain_id(self, t):
+        """Palette index of terrain t, adding it to the palette if need be."""
         if t not in self.terrain_types_reverse:
             self.add_terrain_type(t)
-        self.terrain_array[xy] = self.terrain_types_reverse[t]
+        return self.terrain_types_reverse[t]
+
+    def set_terrain(self, xy, t):
+        tid = self.terrain_id(t)
+        self._log_terrain((xy[0], xy[1], 1, 1))
+        self.terrain_array[xy] = tid
+        self.update_cell(xy)
+
+    def clip_rect(self, rect):
+        """Clip rect (x, y, w, h) to the map; w or h may come out zero."""
+        x, y, w, h = rect
+        x0, y0 = max(x,0), max(y,0)
+        x1, y1 = min(x+w,self.w), min(y+h,self.h)
+        return x0, y0, max(x1-x0,0), max(y1-y0,0)
+
+    def region(self, rect):
+        """Return (terrain ids, passable, opaque) arrays for rect.
+
+        These are views of the map's own layers and must not be
+        modified."""
+        x, y, w, h = rect
+        sl = np.s_[x:x+w, y:y+h]
+        return self.terrain_array[sl], self.passable[sl], self.opaque[sl]
+
+    def _write_terrain(self, rect, ids):
+        """Set the terrain ids inside rect, which must lie on the map.
+
+        ids is an array of the rect's shape, or a single id for every
+        cell. The change is journalled and the passable and opaque
+        layers are brought up to date; all changes to more than one
+        cell's terrain go through here."""
+        x, y, w, h = rect
+        sl = np.s_[x:x+w, y:y+h]
+        self._log_terrain(rect)
+        self.terrain_array[sl] = ids
+        ids = self.terrain_array[sl]
+        self.passable[sl] = self.terrain_passable[ids]
+        self.opaque[sl] = self.terrain_opaque[ids]
+        for xy, l in self.objects.in_rect(rect):
+            self.update_cell(xy)
+        self._changed(rect)
+
+    def fill_rect(self, rect, t):
+        """Set every cell inside rect (x, y, w, h) to terrain t."""
+        tid = self.terrain_id(t)
+        rect = self.clip_rect(rect)
+        self._write_terrain(rect, tid)
+
+    def set_terrain_mask(self, mask, t):
+        """Set terrain t wherever the boolean array mask is true.
+
+        mask must have the same shape as the map."""
+        mask = np.asarray(mask, bool)
+        if mask.shape != self.size:
+            raise ValueError("Mask has shape %s but map is %s" % (mask.shape, self.size))
+        tid = self.terrain_id(t)
+        i, = np.nonzero(mask.any(axis=1))
+        j, = np.nonzero(mask.any(axis=0))
+        if len(i)==0:
+            return
+        rect = x, y, w, h = i[0], j[0], i[-1]+1-i[0], j[-1]+1-j[0]
+        ids = self.region(rect)[0].copy()
+        ids[mask[x:x+w, y:y+h]] = tid
+        self._write_terrain(rect, ids)
+
+    def stamp(self, xy, source, transparent=None):
+        """Copy the Map source onto this map with its corner at xy.
+
+        Terrain is copied cell for cell and the source's objects are
+        added; objects already on this map are left where they are.
+        Source cells whose terrain is transparent (say terrain.void)
+        are skipped. Whatever falls outside this map is dropped."""
+        x, y = xy
+        tx, ty, w, h = self.clip_rect((x, y, source.w, source.h))
+        if w==0 or h==0:
+            return
+        lut = np.array([self.terrain_id(t) for t in source.terrain_types])
+        src = np.s_[tx-x:tx-x+w, ty-y:ty-y+h]
+        ids = source.terrain_array[src]
+        if transparent is None:
+            dst = lut[ids]
+            keep = None
+        else:
+            dst = self.region((tx, ty, w, h))[0].copy()
+            keep = ids != source.terrain_types_reverse.get(transparent, -1)
+            dst[keep] = lut[ids[keep]]
+        # The objects go on first so that writing the terrain brings
+        # the layers up to date with them too
+        for (i,j), l in source.objects.in_rect((tx-x, ty-y, w, h)):
+            if keep is None or keep[i-(tx-x), j-(ty-y)]:
+                for o in l:
+                    self.objects.add((i+x,j+y), o)
+                    self._log('add', (i+x,j+y), o)
+        self._write_terrain((tx, ty, w, h), dst)
+
+    def remap_terrain(self, mapping):
+        """Replace terrain throughout the map according to mapping.
+
+        mapping is a dictionary from Terrain to Terrain; terrains that
+        do not appear on the map's palette are ignored. Old palette
+        entries stay in the palette."""
+        lut = np.arange(len(self.terrain_types))
+        for old, new in mapping.items():
+            if old in self.terrain_types_reverse:
+                lut[self.terrain_types_reverse[old]] = self.terrain_id(new)
+        self._write_terrain((0, 0, self.w, self.h), lut[self.terrain_array])
+
+    def update_cell(self, xy):
+        """Recompute the passable and opaque layers at xy.
+
+        Anything that changes a cell's terrain or contents should
+        go through the Map methods, which call this; call it directly
+        after changing an object on the map behind the Map's back."""
+        t = self.terrain_array[xy]
+        was_passable, was_opaque = self.passable[xy], self.opaque[xy]
+        self.passable[xy], self.opaque[xy] = self._overlay(xy,
+            self.terrain_passable[t], self.terrain_opaque[t])
+        self._changed((xy[0], xy[1], 1, 1), self.opaque[xy] != was_opaque,
+                      self.passable[xy] != was_passable)
+
+    def _changed(self, rect, opacity=True, passability=True):
+        """Tell the caches that something inside rect has changed.
+
+        opacity and passability say whether those may have changed."""
+        if self.fov_cache is not None:
+            self.fov_cache.invalidate(rect, opacity)
+        if opacity and self.los_cache:
+            self.los_cache.clear()
+        if passability:
+            self.passability_version += 1
+
+    def _overlay(self, xy, passable, opaque):
+        """Apply the objects at xy to the terrain's passable and opaque flags."""
+        for o in self.objects.get(xy, ()):
+            if not getattr(o, 'passable', True):
+                passable = False
+            if getattr(o, 'opaque', False):
+                opaque = True
+        return passable, opaque
+
+    def add_object(self, xy, obj):
+        self.objects.add(xy, obj)
+        self._log('add', xy, obj)
+        self.update_cell(xy)
+    def remove_object(self, xy, obj):
+        self.objects.remove(xy, obj)
+        self._log('remove', xy, obj)
+        self.update_cell(xy)
+    def clear_objects(self, xy):
+        l = self.objects.clear(xy)
+        if l:
+            for obj in l:
+                self._log('remove', xy, obj)
+            self.update_cell(xy)
+    def move_object(self, obj, from_, to):
+        self.remove_object(from_, obj)
+        self.add_object(to, obj)
+    def set_door_closed(self, xy, door, closed):
+        self._log('door', xy, door, door.closed)
+        door.closed = closed
+        self.update_cell(xy)
+
+    def start_journal(self):
+        """Start recording changes to the map; returns the Journal."""
+        if self.journal is None:
+            self.journal = Journal()
+        return self.journal
+    def stop_journal(self):
+        self.journal = None
+
+    @property
+    def version(self):
+        """The journal's version, or None if there is no journal."""
+        if self.journal is None:
+            return None
+        return self.journal.version
+
+    def _log(self, kind, where, obj=None, before=None):
+        if self.journal is not None:
+            self.journal.record(kind, where, obj, before)
+    def _log_terrain(self, rect):
+        """Note the terrain inside rect before it is overwritten."""
+        if self.journal is not None:
+            x, y, w, h = rect
+            self.journal.record('terrain', rect, None,
+                (self.terrain_array[x:x+w, y:y+h].copy(), self.terrain_types))
+
+    def undo(self, version):
+        """Undo the journalled changes made since version.
+
+        The changes are reversed newest first through the usual Map
+        methods, so the undoing is itself journalled and the version
+        keeps increasing."""
+        for c in reversed(self.journal.since(version)):
+            self._undo_change(c)
+    def _undo_change(self, c):
+        if c.kind == 'terrain':
+            ids, palette = c.before
+            x, y, w, h = c.where
+            if w == h == 1:
+                self.set_terrain((x,y), palette[ids[0,0]])
+            else:
+                lut = np.array([self.terrain_id(t) for t in palette])
+                self._write_terrain(c.where, lut[ids])
+        elif c.kind == 'add':
+            self.remove_object(c.where, c.obj)
+        elif c.kind == 'remove':
+            self.add_object(c.where, c.obj)
+        elif c.kind == 'door':
+            self.set_door_closed(c.where, c.obj, c.before)
     
     def __str__(self):
-        return ("Map {0} by {1}:\n".format(self.w, self.h) + 
-            "\n".join("".join(self.terrain_types[v].roguechar for v in l) 
-                        for l in self.terrain_array.T))
+        # Look up each cell's character code, add a column of newlines
+        # and let UTF-32 decoding turn the whole block into text
+        table = np.array([ord(t.roguechar) for t in self.terrain_types], np.uint32)
+        codes = np.empty((self.h, self.w+1), np.uint32)
+        codes[:,:-1] = table[self.terrain_array.T]
+        codes[:,-1] = ord("\n")
+        s = (u"Map {0} by {1}:\n".format(self.w, self.h) +
+             codes.tostring().decode('UTF-32LE')[:-1])
+        try:
+            s = s.encode('ascii')
+        except UnicodeEncodeError:
+            pass
+        return s
+    # Attributes rebuilt from the saved layers rather than saved themselves
+    _derived_state = ['terrain_array', 'terrain_types_reverse', 'w', 'h',
+                      'objects', 'terrain_passable', 'terrain_opaque',
+                      'passable', 'opaque']
+
     def __getstate__(self):
+        """Save the map in columns: palette, terrain block, sparse objects.
+
+        The terrain ids are stored as one zlib-compressed, base64-encoded
+        block of little-endian integers, indexed [x,y] in C order."""
         d = self.__dict__.copy()
-        del d['terrain_array']
-        del d['terrain_types_reverse']
-        del d['terrain_types']
-        del d['size']
-        del d['w']
-        del d['h']
-        del d['objects']
-        cells = np.zeros_like(self.terrain_array)
-        cell_types = { (self.terrain_types[0], ()): 0 }
-        cell_chars = [' ']
-        n_cell_types = 1
-        unicode_used = 0
-        for i in range(self.w):
-            for j in range(self.h):
-                terrain_ = self.terrain_types[self.terrain_array[i,j]]
-                contents = tuple(self.objects[i,j])
-                if (terrain_,contents) not in cell_types:
-                    cell_types[terrain_,contents] = n_cell_types
-                    n_cell_types += 1
-                    # choose a Unicode character
-                    # FIXME: try all contents then the terrain hoping
-                    # for an unused character
-                    if contents:
-                        ch = contents[-1].roguechar
-                    else:
-                        ch = terrain_.roguechar
-                    while ch in cell_chars:
-                        ch = usable_unicode_chars[unicode_used]
-                        unicode_used += 1
-                    cell_chars.append(ch)
-                cells[i,j] = cell_types[terrain_,contents]
-
-        d['map'] = '\n'.join("".join(cell_chars[cells[i,j]] for i in range(self.w)) for j in range(self.h))+"\n"
-        d['cell_types'] = {}
-        for (k,v) in cell_types.items():
-            c = cell_chars[v]
-            if c == ' ':
-                continue
-            try:
-                c = c.encode('ascii')
-            except UnicodeEncodeError:
-                pass
-            terrain_, contents = k
-            d['cell_types'][c] = [terrain_]+list(contents)
+        for k in self._derived_state:
+            del d[k]
+        for k in self._transient_state:
+            d.pop(k, None)
+        a = self.terrain_array.astype(self.terrain_array.dtype.newbyteorder('<'))
+        d['size'] = list(self.size)
+        d['terrain_types'] = list(self.terrain_types)
+        d['terrain_dtype'] = a.dtype.str
+        d['terrain'] = base64.b64encode(zlib.compress(a.tostring()))
+        d['objects'] = [[list(xy)]+list(l) for (xy, l) in self.objects.items()]
         return d
     def __setstate__(self, d):
+        if 'cell_types' in d:
+            self._setstate_cell_map(d)
+            return
+        terrain_types = d.pop('terrain_types')
+        a = np.fromstring(zlib.decompress(base64.b64decode(d.pop('terrain'))),
+                          np.dtype(d.pop('terrain_dtype')))
+        objects = d.pop('objects')
+
+        self.__dict__ = d
+        self.size = tuple(self.size)
+        self.w, self.h = self.size
+        self.terrain_array = a.reshape(self.size).astype(terrain_dtype(len(terrain_types)))
+        self._set_palette(terrain_types)
+        self.objects = ObjectLayer()
+        for l in objects:
+            for o in l[1:]:
+                self.objects.add(tuple(l[0]), o)
+        self.passable = self.terrain_passable[self.terrain_array]
+        self.opaque = self.terrain_opaque[self.terrain_array]
+        for xy in self.objects:
+            self.update_cell(xy)
+
+    def _setstate_cell_map(self, d):
+        """Load a map saved in the older format, as a string of cells."""
         cell_types = d.pop('cell_types')
         cell_map = d.pop('map')
 
@@ -134,54 +668,188 @@ class Map(yaml.YAMLObject):
         for l in cell_map.split("\n"):
             self.w = max(len(l),self.w)
  
-        self.size = (self.w, self.h)
-        self.terrain_array = np.zeros(self.size, np.uint8)
-        self.terrain_types = [terrain.void]
-        self.terrain_types_reverse = { self.terrain_types[0]: 0 }
-        self.objects = collections.defaultdict(list)
+        self._init_layers((self.w, self.h))
         for j,l in enumerate(cell_map.split("\n")):
             for i,c in enumerate(l):
                 tc = cell_types[c]
                 terrain_ = tc[0]
                 contents = tc[1:]
                 self.set_terrain((i,j),terrain_)
-                self.objects[i,j].extend(contents)
+                for o in contents:
+                    self.add_object((i,j), o)
 
     def is_opaque(self, ij):
-        i,j = ij
-        if self.terrain((i,j)).opaque:
-            return True
-        else:
-            for o in self.objects[i,j]:
-                if o.opaque:
-                    return True
-        return False
+        return self.opaque[ij]
     def is_passable(self, ij):
-        i,j = ij
-        if not self.terrain((i,j)).passable:
-            return False
+        return self.passable[ij]
+    def occupied(self, ignore=(), rect=None):
+        """Boolean array of the cells inside rect holding an actor.
+
+        rect defaults to the whole map, and should lie on it. Actors
+        in ignore are not counted."""
+        x, y, w, h = (0, 0, self.w, self.h) if rect is None else rect
+        mask = np.zeros((w, h), bool)
+        for (i,j), obj in self.objects.of_kind('actors'):
+            if obj not in ignore and x <= i < x+w and y <= j < y+h:
+                mask[i-x, j-y] = True
+        return mask
+    def planning_rect(self, a, b):
+        """The rect (x, y, w, h) to look for paths from a to b in.
+
+        Planners work on region() and occupied() of this rect; on a
+        Map it is the whole map."""
+        return 0, 0, self.w, self.h
+    def look(self, char, radius=None, compact=False):
+        """List everything the character can see from its current position
+
+        By default the character can see as far as its sight_radius
+        attribute, or to the edges of the map if it has none. The
+        character's fov_algorithm attribute, if it has one, picks the
+        field of view algorithm, otherwise the map's is used. A
+        character with a true vision_cone attribute only sees the 90
+        degree cone it faces, given by its orientation.
+
+        The list holds (xy, terrain) for each visible cell and (xy, obj)
+        for each object on one. If compact is true a Sight is returned
+        instead, with the terrain as an array of ids. Either is cached
+        until something in view changes, so it must not be modified."""
+        if radius is None:
+            radius = getattr(char, 'sight_radius', None)
+        if radius is None:
+            radius = self.w+self.h
+        algorithm = getattr(char, 'fov_algorithm', None)
+        facing = None
+        if getattr(char, 'vision_cone', False):
+            facing = orientation_to_delta[char.orientation]
+        v = self._cached_view(char.coords, radius, algorithm, facing)
+        if compact:
+            if v.sight is None:
+                v.sight = self._sight(v.coords)
+            return v.sight
+        if v.things is None:
+            r = []
+            for xy in zip(*[n.tolist() for n in v.coords]):
+                r.append((xy, self.terrain(xy)))
+                for m in self.objects[xy]:
+                    r.append((xy,m))
+            v.things = r
+        return v.things
+    def _sight(self, coords):
+        xs, ys = coords
+        x0, y0 = int(xs.min()), int(ys.min())
+        seen = np.zeros((xs.max()-x0+1, ys.max()-y0+1), bool)
+        seen[xs-x0, ys-y0] = True
+        objects = []
+        for (x,y), l in self.objects.in_rect((x0, y0) + seen.shape):
+            if seen[x-x0, y-y0]:
+                objects.extend(((x,y), m) for m in l)
+        return Sight(coords, self.terrain_ids(coords), objects, self.terrain_types)
+    def terrain_ids(self, coords):
+        """The terrain ids at the cells (xs, ys), as an array."""
+        return self.terrain_array[coords]
+    def visible_cells(self, xy, radius, algorithm=None, facing=None):
+        """Coordinates (xs, ys) of the cells visible from xy.
+
+        algorithm is the name of one of fov.algorithms, by default
+        the map's fov_algorithm. If facing is a step (dx, dy) from
+        orientation_to_delta only the 90 degree cone in that direction
+        is looked at. The arrays may be shared with the FOV cache and
+        must not be modified."""
+        return self._cached_view(xy, radius, algorithm, facing).coords
+    def _cached_view(self, xy, radius, algorithm, facing=None):
+        if algorithm is None:
+            algorithm = self.fov_algorithm
+        if self.fov_cache is None:
+            self.fov_cache = FOVCache()
+        if facing is not None:
+            facing = tuple(facing)
+        key = tuple(xy), radius, algorithm, facing
+        v = self.fov_cache.get(key)
+        if v is None:
+            quadrants = None
+            if facing is not None:
+                quadrants = fov.directionQuadrants(*facing)
+            coords = self._visible_cells(xy, radius, algorithm, quadrants)
+            if algorithm == 'permissive':
+                # Everything seen in the quadrants scanned decides the
+                # view, not just what is left in the cone
+                xs, ys = coords
+                rect = xs.min(), ys.min(), xs.ptp()+1, ys.ptp()+1
+            else:
+                # The other algorithms may look at cells they do not
+                # show, so anything within reach can change the view
+                x, y = xy
+                rect = self.clip_rect((x-radius, y-radius, 2*radius+1, 2*radius+1))
+            if facing is not None:
+                xs, ys = coords
+                keep = fov.inCone(xs-xy[0], ys-xy[1], *facing)
+                coords = xs[keep], ys[keep]
+            v = self.fov_cache.put(key, coords, rect)
+        return v
+    def _visible_cells(self, xy, radius, algorithm, quadrants=None):
+        """Cells visible from xy, looking into at least the given quadrants."""
+        # Only the box the view can reach is looked at
+        x, y = xy
+        x0, y0, w, h = self.clip_rect((x-radius, y-radius, 2*radius+1, 2*radius+1))
+        opaque = self.region((x0, y0, w, h))[2]
+        x, y = x-x0, y-y0
+        if algorithm != 'permissive' or quadrants is not None or \
+                (w, h) != (2*radius+1, 2*radius+1):
+            # Where the view reaches the edge of the map a step changes
+            # the extents of the quadrants, and nothing can be reused
+            mask = view_mask(opaque, (x, y), radius, algorithm, quadrants)
         else:
-            for o in self.objects[i,j]:
-                if hasattr(o,'passable') and not o.passable:
-                    return False
-        return True
-    def look(self, char):
-        """List everything the character can see from its current position"""
-        r = []
-        def see(x,y):
-            r.append(((x,y), self.terrain((x,y))))
-            for m in self.objects[(x,y)]:
-                r.append(((x,y),m))
-        fov.fieldOfView(char.coords[0], char.coords[1], self.w, self.h, self.w+self.h,
-            see, lambda x,y: self.is_opaque((x,y)))
+            # Characters mostly move a step at a time, so start from
+            # the last view worked out with this radius
+            if self.fov_trackers is None:
+                self.fov_trackers = {}
+            if radius not in self.fov_trackers:
+                self.fov_trackers[radius] = fov.IncrementalFOV(radius)
+            mask = self.fov_trackers[radius].update(opaque, x, y)
+        xs, ys = np.nonzero(mask)
+        return xs+x0, ys+y0
+    def line_of_sight(self, a, b, radius=None):
+        """Whether b can be seen from a.
+
+        The answer is the same as asking whether b is among
+        visible_cells(a, radius) with precise permissive FOV, but only
+        the cells along the line are looked at. Answers are cached
+        until opacity changes anywhere on the map."""
+        if self.los_cache is None:
+            self.los_cache = {}
+        key = tuple(a), tuple(b), radius
+        r = self.los_cache.get(key)
+        if r is None:
+            if len(self.los_cache) >= 65536:
+                self.los_cache.clear()
+            r = self.los_cache[key] = self._line_of_sight(a, b, radius)
         return r
-    def lsobjects(self, filterfunc=None):
-        """Return a set of all objects on the map, optionally filtered."""
-        #TODO? optionally only return objects inside a certain rect of coords
+    def lines_of_sight(self, pairs, radius=None):
+        """line_of_sight for a list of pairs (a, b), as a boolean array."""
+        if self.los_cache is None:
+            self.los_cache = {}
+        keys = [(tuple(a), tuple(b), radius) for (a, b) in pairs]
+        todo = [k for k in set(keys) if k not in self.los_cache]
+        if todo:
+            if len(self.los_cache) + len(todo) > 65536:
+                self.los_cache.clear()
+            r = self._lines_of_sight([(a, b) for (a, b, radius) in todo], radius)
+            self.los_cache.update(zip(todo, r.tolist()))
+        return np.array([self.los_cache[k] for k in keys], bool)
+    def _line_of_sight(self, a, b, radius):
+        return fov.lineOfSight(self.opaque, a[0], a[1], b[0], b[1], radius)
+    def _lines_of_sight(self, pairs, radius):
+        return fov.linesOfSight(self.opaque, pairs, radius)
+    def lsobjects(self, filterfunc=None, rect=None):
+        """Return a set of all objects on the map, optionally filtered.
+
+        If rect (x, y, w, h) is given, only objects inside it are returned."""
         ls = set()
-        #[[ls.update(set(matches)) for matches in filter(filterfunc, tile_contents)]
-        #   for tile_contents in self.objects.values()]
-        for tile_contents in self.objects.values():
+        if rect is None:
+            cells = self.objects.values()
+        else:
+            cells = (l for (xy, l) in self.objects.in_rect(rect))
+        for tile_contents in cells:
             for obj in tile_contents:
                 if not filterfunc:
                     ls.add(obj)
@@ -226,46 +894,57 @@ twls[u'┤'] = Feature("tw-jl",  u"┤", image.Image(twfile, colors, (64*3, 96*2
 twls[u'┼'] = Feature("tw-jx",  u"┼", image.Image(twfile, colors, (64*3, 96*3, 64,96)), False, True)
 
 
+ascii_terrain = {u'#': terrain.wall, u'.': terrain.floor}
+
 def load_ascii_map(f):
-    a = [line.decode('UTF-8') for line in open(f,"rt").readlines()]
+    text = open(f,"rt").read().decode('UTF-8')
     #FIXME? detect file encoding automatically
-    for i, l in enumerate(a):
-        if l[-1] == "\n":
-            a[i] = l[:-1]
+    a = text.split("\n")
+    if text.endswith("\n"):
+        a = a[:-1]
     if not a[-1]:
         a = a[:-1]
     w = max(len(l) for l in a)
-    a = [l+" "*(w-len(l)) for l in a]
-    M = Map((w,len(a)))
-    doors = set()
-    for j, l in enumerate(a):
-        for i, c in enumerate(l):
-            obj = []
-            if c=="#":
-                c = terrain.wall
-            elif c==".":
-                c = terrain.floor
-
-            elif c in twls:
-                obj = [twls[c]]
-                c = terrain.floor
-
-            elif c=='+':
-                c = terrain.floor
-                doors.add((i,j))
+    h = len(a)
+    # Character codes indexed [x,y] like the map
+    grid = np.frombuffer(u"".join(l+u" "*(w-len(l)) for l in a).encode('UTF-32LE'),
+                         np.uint32).reshape((h,w)).T
+    codes, inverse = np.unique(grid, return_inverse=True)
+    inverse = inverse.reshape(grid.shape)
+    M = Map((w,h))
+    # Decide what each distinct character means just once
+    ids = []
+    features = []
+    for k, code in enumerate(codes):
+        c = unichr(code)
+        if c in ascii_terrain:
+            ids.append(M.terrain_id(ascii_terrain[c]))
+        elif c in twls or c=='+':
+            ids.append(M.terrain_id(terrain.floor))
+        else:
+            ids.append(M.terrain_id(terrain.void))
+        if c in twls:
+            features.append((inverse==k, twls[c]))
+    M.terrain_array[...] = np.array(ids, M.terrain_array.dtype)[inverse]
+    M.passable[...] = M.terrain_passable[M.terrain_array]
+    M.opaque[...] = M.terrain_opaque[M.terrain_array]
+    # The map is empty so far, so objects can be laid on whole masks
+    for mask, f in features:
+        for xy in zip(*[n.tolist() for n in np.nonzero(mask)]):
+            M.objects.add(xy, f)
+        M.passable[mask] &= bool(f.passable)
+        M.opaque[mask] |= bool(f.opaque)
 
-            else:
-                c = terrain.void
-            M.set_terrain((i,j),c)
-            M.objects[i,j].extend(obj)
-    for (i,j) in doors:
-        hscore = 0
-        vscore = 0
-        if not M.is_passable((i-1,j)): hscore += 1
-        if not M.is_passable((i+1,j)): hscore += 1
-        if not M.is_passable((i,j+1)): vscore += 1
-        if not M.is_passable((i,j-1)): vscore += 1
-        M.objects[i,j].append(Door(Door.OR_HORI if hscore>vscore else Door.OR_VERT))
+    # Doors run across whichever axis has more blocked neighbours
+    blocked = (~M.passable).astype(int)
+    hscore = np.roll(blocked, 1, 0) + np.roll(blocked, -1, 0)
+    vscore = np.roll(blocked, 1, 1) + np.roll(blocked, -1, 1)
+    doors = grid==ord('+')
+    for (i,j) in zip(*[n.tolist() for n in np.nonzero(doors)]):
+        M.objects.add((i,j), Door(Door.OR_HORI if hscore[i,j]>vscore[i,j] else Door.OR_VERT))
+    # New doors are closed
+    M.passable[doors] = False
+    M.opaque[doors] = True
     return M
 
 
@@ -336,68 +1015,18 @@ orien: orientation (eg. Door.OR_HORI). None means auto-detect."""
 
 
 
-class NoPathException(ValueError):
-    def __init__(self, best_effort=None):
-        ValueError.__init__(self, "Path not found")
-        self.best_effort=best_effort
-
-root2 = np.sqrt(2)
-def find_path(x1y1,x2y2,passable):
-
-    def dist(x1y1, x2y2):
-        x1,y1 = x1y1
-        x2,y2 = x2y2
-        return np.hypot(x1-x2,y1-y2)
-
-    path_to = {x1y1: ((x1y1,),0)}
-    costs = [(dist(x1y1,x2y2), x1y1)]
-
-    closest = np.inf, None
-
-    while costs:
-        d, node = heapq.heappop(costs)
-        if node == x2y2:
-            return path_to[x2y2]
-
-        dd = dist(node,x2y2)
-        if dd < closest[0]:
-            closest = dd, node
-
-        path_so_far, l_so_far = path_to[node]
-
-        nx, ny = node
-        #FIXME: make pathfinding more random
-        for i in (-1,0,1):
-            for j in (-1,0,1):
-                nbx, nby = nx+i, ny+j
-                if not passable(nbx,nby):
-                    continue
-                l = l_so_far + np.hypot(i,j)
-                if (nbx,nby) in path_to:
-                    pp, ll = path_to[nbx,nby]
-                    if ll<=l:
-                        continue
-                    # new shortest path to this node
-                    # so remove it from the queue (if it's there)
-                    # and fall through to the "new node" code
-                    costs = [(d,n) for (d,n) in costs if n!=(nbx,nby)]
-                # this is the shortest known path to (nbx,nby)
-                path_to[nbx,nby] = path_so_far + ((nbx,nby),), l
-
-                # How promising is it?
-                cost = l+dist((nbx,nby),x1y1)
-
-                heapq.heappush(costs, (cost,(nbx,nby)))
-
-    raise NoPathException(path_to[closest[1]])
-
-
-
 if __name__ == '__main__':
+    import os
+    import shutil
+    import tempfile
     M = load_ascii_map(util.data_dir("testmap2.txt"))
-    f = open(util.data_dir("testmap2.yaml"),"w")
-    yaml.dump(M,f, encoding="UTF8", allow_unicode=True)
-    f.close()
-    f = open(util.data_dir("testmap2.yaml,roundtrip"),"w")
-    yaml.dump(yaml.load(yaml.dump(M)),f, encoding="UTF8", allow_unicode=True)
-    f.close()
+    d = tempfile.mkdtemp()
+    try:
+        f = open(os.path.join(d, "testmap2.yaml"),"w")
+        yaml.dump(M,f, encoding="UTF8", allow_unicode=True)
+        f.close()
+        f = open(os.path.join(d, "testmap2.yaml,roundtrip"),"w")
+        yaml.dump(yaml.load(yaml.dump(M)),f, encoding="UTF8", allow_unicode=True)
+        f.close()
+    finally:
+        shutil.rmtree(d)
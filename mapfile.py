@@ -0,0 +1,133 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2012 Anne Archibald <peridot.faceted@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#
+#
+
+"""Binary map files whose layers can be memory-mapped.
+
+A map file starts with MAGIC and the length of a YAML header, followed
+by the header itself. The header records the map size, the palette,
+the objects on the map and the dtype and offset of each layer. The
+layers (terrain ids, passable, opaque) follow as raw arrays, each
+starting on a page boundary so that np.memmap can open them directly.
+
+Opening a map therefore only reads the header; terrain pages are read
+when they are first touched, and several processes opening the same
+file share them through the page cache.
+"""
+
+import struct
+
+import numpy as np
+
+import yaml
+import gamemap
+
+MAGIC = "GHPMAP\x00\x01"
+ALIGN = 4096
+LAYERS = ['terrain_array', 'passable', 'opaque']
+
+def _aligned(n):
+    return -(-n//ALIGN)*ALIGN
+
+def save_map(M, filename):
+    """Write M to filename in the binary map format."""
+    header = {
+        'size': list(M.size),
+        'terrain_types': list(M.terrain_types),
+        'objects': [[list(xy)]+list(l) for (xy, l) in M.objects.items()],
+        'layers': {},
+        }
+    # Offsets depend on the header length, so lay out the layers
+    # relative to the first page after the header and fix up later
+    layer_offsets = []
+    offset = 0
+    for name in LAYERS:
+        a = getattr(M, name)
+        layer_offsets.append((name, a, offset))
+        header['layers'][name] = {'dtype': a.dtype.str, 'offset': offset}
+        offset = _aligned(offset + a.nbytes)
+    text = yaml.dump(header, encoding="UTF8", allow_unicode=True)
+    base = _aligned(len(MAGIC) + 8 + len(text) + ALIGN)
+    for name in LAYERS:
+        header['layers'][name]['offset'] += base
+    text = yaml.dump(header, encoding="UTF8", allow_unicode=True)
+    assert len(MAGIC) + 8 + len(text) <= base
+
+    f = open(filename, "wb")
+    try:
+        f.write(MAGIC)
+        f.write(struct.pack("<Q", len(text)))
+        f.write(text)
+        for name, a, offset in layer_offsets:
+            f.seek(base + offset)
+            np.ascontiguousarray(a).tofile(f)
+    finally:
+        f.close()
+
+def read_header(filename):
+    f = open(filename, "rb")
+    try:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s does not appear to be a map file" % filename)
+        n, = struct.unpack("<Q", f.read(8))
+        return yaml.load(f.read(n))
+    finally:
+        f.close()
+
+def load_map(filename, mode='r'):
+    """Open a map file, memory-mapping its layers.
+
+    mode is passed on to np.memmap: 'r' gives a read-only map (any
+    attempt to change terrain or open a door raises an error), 'c'
+    gives a private copy-on-write map, and 'r+' writes changes back
+    to the file.
+    """
+    header = read_header(filename)
+    M = gamemap.Map.__new__(gamemap.Map)
+    M.size = tuple(header['size'])
+    M.w, M.h = M.size
+    M._set_palette(header['terrain_types'])
+    for name in LAYERS:
+        layer = header['layers'][name]
+        setattr(M, name, np.memmap(filename, np.dtype(layer['dtype']), mode,
+                                   layer['offset'], M.size))
+    # The stored layers already include the objects' overlay
+    M.objects = gamemap.ObjectLayer()
+    for l in header['objects']:
+        for o in l[1:]:
+            M.objects.add(tuple(l[0]), o)
+    return M
+
+if __name__=='__main__':
+    import os
+    import shutil
+    import tempfile
+    import util
+    M = gamemap.load_ascii_map(util.data_dir("testmap2.txt"))
+    d = tempfile.mkdtemp()
+    try:
+        save_map(M, os.path.join(d, "testmap2.ghpmap"))
+        M2 = load_map(os.path.join(d, "testmap2.ghpmap"))
+    finally:
+        shutil.rmtree(d)
+    assert str(M) == str(M2)
+    assert (M.passable == M2.passable).all() and (M.opaque == M2.opaque).all()
+    print M2
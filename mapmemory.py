@@ -0,0 +1,139 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2012 Anne Archibald <peridot.faceted@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#
+#
+
+"""What a character remembers of a map.
+
+A MapMemory keeps a mask of the cells that have been explored, the
+terrain last seen on each, and the objects last seen, stored sparsely.
+It is brought up to date with the Sight returned by
+Map.look(char, compact=True), which takes a few numpy operations on
+the visible cells rather than a Python call per cell.
+
+For drawing, a MapMemory looks like a Map: it has size, w, h,
+terrain(xy) and objects. Cells never seen show as terrain.void.
+"""
+
+import numpy as np
+
+import gamemap
+import terrain
+
+class MapMemory(object):
+    """The explored part of a map of the given size, as last seen."""
+    def __init__(self, size):
+        self.size = size
+        self.w, self.h = self.size
+        self.explored = np.zeros(self.size, bool)
+        # Remembered terrain, as ids into terrain_types; 0 is void
+        self.terrain_array = np.zeros(self.size, np.uint16)
+        self.terrain_types = [terrain.void]
+        self.terrain_types_reverse = {terrain.void: 0}
+        self.objects = gamemap.ObjectLayer()
+        # Translation from the ids of the last palette seen to ours
+        self._palette = None
+        self._lut = None
+
+    def terrain_id(self, t):
+        """Our id for terrain t, adding it to the palette if need be."""
+        if t not in self.terrain_types_reverse:
+            self.terrain_types_reverse[t] = len(self.terrain_types)
+            self.terrain_types.append(t)
+        return self.terrain_types_reverse[t]
+    def terrain(self, xy):
+        return self.terrain_types[self.terrain_array[xy]]
+
+    def _translation(self, palette):
+        # The map's palette only ever grows in place, or is replaced
+        # by a new list, so this notices any change
+        if palette is not self._palette or len(palette) != len(self._lut):
+            self._palette = palette
+            self._lut = np.array([self.terrain_id(t) for t in palette],
+                                 self.terrain_array.dtype)
+        return self._lut
+
+    def see(self, sight):
+        """Remember what is in sight, a gamemap.Sight.
+
+        Objects remembered on the visible cells that are no longer
+        there are forgotten."""
+        xs, ys = sight.coords
+        self.explored[xs, ys] = True
+        self.terrain_array[xs, ys] = self._translation(sight.palette)[sight.terrain]
+
+        x0, y0 = int(xs.min()), int(ys.min())
+        seen = np.zeros((xs.max()-x0+1, ys.max()-y0+1), bool)
+        seen[xs-x0, ys-y0] = True
+        for (x,y), l in list(self.objects.in_rect((x0, y0) + seen.shape)):
+            if seen[x-x0, y-y0]:
+                self.objects.clear((x,y))
+        for xy, obj in sight.objects:
+            self.objects.add(xy, obj)
+
+    def forget(self):
+        """Forget everything."""
+        self.explored[...] = False
+        self.terrain_array[...] = 0
+        self.objects = gamemap.ObjectLayer()
+
+if __name__=='__main__':
+    import time
+    import util
+
+    class Viewer(object):
+        pass
+    M = gamemap.load_ascii_map(util.data_dir("testmap2.txt"))
+    v = Viewer()
+    xs, ys = np.nonzero(M.passable)
+    spots = zip(xs.tolist(), ys.tolist())
+
+    views = []
+    sights = []
+    for xy in spots:
+        v.coords = xy
+        views.append(M.look(v))
+        sights.append(M.look(v, compact=True))
+
+    # The old way: copy what is seen into a second Map cell by cell
+    shadow = gamemap.Map(M.size)
+    t = time.time()
+    for things in views:
+        for coords, obj in things:
+            if isinstance(obj, terrain.Terrain):
+                shadow.set_terrain(coords, obj)
+                shadow.clear_objects(coords)
+        for coords, obj in things:
+            if not isinstance(obj, terrain.Terrain):
+                shadow.add_object(coords, obj)
+    told = (time.time()-t)/len(spots)
+
+    memory = MapMemory(M.size)
+    t = time.time()
+    for sight in sights:
+        memory.see(sight)
+    tnew = (time.time()-t)/len(spots)
+
+    for i in range(M.w):
+        for j in range(M.h):
+            assert memory.terrain((i,j)) == shadow.terrain((i,j))
+            assert list(memory.objects[i,j]) == list(shadow.objects[i,j])
+    print "%d views of testmap2: shadow Map %.3f ms, MapMemory %.3f ms per view" % \
+        (len(spots), 1000*told, 1000*tnew)
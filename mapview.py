@@ -0,0 +1,282 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2012 Anne Archibald <peridot.faceted@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#
+#
+
+"""Copy-on-write views of a Map for trying things out.
+
+A MapView looks exactly like the map it is made from until something
+is changed through it; the change is kept in the view and the map
+underneath is left alone. Only the cells that were changed take up
+any room, so a view costs next to nothing to make, and views can be
+stacked (see MapView.branch) to explore a tree of possibilities.
+
+Doors are shared between the map and its views, so opening a door
+in a view records the door's state in the view instead of touching
+the Door itself.
+
+The underlying map must not be changed while views of it are in use;
+they would see some of the change and not the rest.
+"""
+
+import numpy as np
+
+import fov
+import gamemap
+
+class ViewObjects(object):
+    """The objects on a MapView, indexed by cell like an ObjectLayer."""
+    def __init__(self, view):
+        self.view = view
+    def __getitem__(self, xy):
+        return self.view.contents(xy)
+    def get(self, xy, default=()):
+        return self.view.contents(xy) or default
+    def __contains__(self, xy):
+        return bool(self.view.contents(xy))
+
+class MapView(object):
+    """A copy-on-write view of a Map (or of another MapView).
+
+    The usual Map interface for reading and changing terrain and
+    objects works on a view: terrain, set_terrain, is_passable,
+    is_opaque, objects[xy], add_object, remove_object, clear_objects,
+    move_object, set_door_closed and look.
+    """
+    def __init__(self, base):
+        self.base = base
+        self.size = base.size
+        self.w, self.h = self.size
+        self.objects = ViewObjects(self)
+        # Only cells changed in this view appear in these
+        self.terrain_overrides = {}
+        self.contents_overrides = {}
+        self.door_overrides = {}
+        self.flags = {}
+
+    def branch(self):
+        """A new view on top of this one."""
+        return MapView(self)
+
+    def changed_cells(self):
+        """The cells changed in this view (not counting the ones below)."""
+        return set(self.flags)
+
+    def terrain(self, xy):
+        t = self.terrain_overrides.get(xy)
+        if t is None:
+            return self.base.terrain(xy)
+        return t
+    def contents(self, xy):
+        l = self.contents_overrides.get(xy)
+        if l is None:
+            return self.base.objects[xy]
+        return l
+    def door_closed(self, door):
+        """Whether door is closed as seen in this view."""
+        v = self
+        while isinstance(v, MapView):
+            if door in v.door_overrides:
+                return v.door_overrides[door]
+            v = v.base
+        return door.closed
+
+    def is_passable(self, xy):
+        f = self.flags.get(xy)
+        if f is None:
+            return self.base.is_passable(xy)
+        return f[0]
+    def is_opaque(self, xy):
+        f = self.flags.get(xy)
+        if f is None:
+            return self.base.is_opaque(xy)
+        return f[1]
+
+    @property
+    def fov_algorithm(self):
+        return self.base.fov_algorithm
+    def clip_rect(self, rect):
+        return self.base.clip_rect(rect)
+
+    def layers(self, rect=None):
+        """Return (passable, opaque) arrays for rect in this view.
+
+        rect (x, y, w, h) must lie on the map, and defaults to all of
+        it. These are fresh copies of the base map's layers with this
+        view's changes applied, so they cost as much as copying that
+        much of the map."""
+        if rect is None:
+            rect = 0, 0, self.w, self.h
+        x, y, w, h = rect
+        if isinstance(self.base, MapView):
+            passable, opaque = self.base.layers(rect)
+        else:
+            ids, passable, opaque = self.base.region(rect)
+            passable, opaque = passable.copy(), opaque.copy()
+        for (i,j), (p, o) in self.flags.items():
+            if x <= i < x+w and y <= j < y+h:
+                passable[i-x,j-y], opaque[i-x,j-y] = p, o
+        return passable, opaque
+
+    def update_cell(self, xy):
+        t = self.terrain(xy)
+        passable, opaque = bool(t.passable), bool(t.opaque)
+        for o in self.contents(xy):
+            if isinstance(o, gamemap.Door):
+                closed = self.door_closed(o)
+                passable = passable and not closed
+                opaque = opaque or closed
+            else:
+                if not getattr(o, 'passable', True):
+                    passable = False
+                if getattr(o, 'opaque', False):
+                    opaque = True
+        self.flags[xy] = passable, opaque
+
+    def set_terrain(self, xy, t):
+        self.terrain_overrides[xy] = t
+        self.update_cell(xy)
+
+    def _own_contents(self, xy):
+        """The list of objects at xy, copied into this view if need be."""
+        l = self.contents_overrides.get(xy)
+        if l is None:
+            l = self.contents_overrides[xy] = list(self.base.objects[xy])
+        return l
+    def add_object(self, xy, obj):
+        self._own_contents(xy).append(obj)
+        self.update_cell(xy)
+    def remove_object(self, xy, obj):
+        self._own_contents(xy).remove(obj)
+        self.update_cell(xy)
+    def clear_objects(self, xy):
+        if self.contents(xy):
+            self.contents_overrides[xy] = []
+            self.update_cell(xy)
+    def move_object(self, obj, from_, to):
+        self.remove_object(from_, obj)
+        self.add_object(to, obj)
+    def set_door_closed(self, xy, door, closed):
+        self.door_overrides[door] = closed
+        self.update_cell(xy)
+
+    def look(self, char, radius=None, compact=False):
+        """List everything the character can see, as for Map.look.
+
+        The character's sight_radius, fov_algorithm and vision_cone
+        count as they do there, and compact gives a gamemap.Sight in
+        the same way, but nothing is cached: views are expected to
+        change."""
+        if radius is None:
+            radius = getattr(char, 'sight_radius', None)
+        if radius is None:
+            radius = self.w+self.h
+        algorithm = getattr(char, 'fov_algorithm', None) or self.fov_algorithm
+        quadrants = facing = None
+        if getattr(char, 'vision_cone', False):
+            facing = gamemap.orientation_to_delta[char.orientation]
+            quadrants = fov.directionQuadrants(*facing)
+        # Only the box the view can reach is copied out of the view
+        x, y = char.coords
+        x0, y0, w, h = rect = self.clip_rect((x-radius, y-radius, 2*radius+1, 2*radius+1))
+        mask = gamemap.view_mask(self.layers(rect)[1], (x-x0, y-y0), radius,
+                                 algorithm, quadrants)
+        xs, ys = np.nonzero(mask)
+        if facing is not None:
+            keep = fov.inCone(xs-(x-x0), ys-(y-y0), *facing)
+            xs, ys = xs[keep], ys[keep]
+        xs, ys = xs+x0, ys+y0
+        if compact:
+            return self._sight((xs, ys))
+        r = []
+        for xy in zip(xs.tolist(), ys.tolist()):
+            r.append((xy, self.terrain(xy)))
+            for m in self.contents(xy):
+                r.append((xy,m))
+        return r
+    def _sight(self, coords):
+        """What the map below shows of coords, as a gamemap.Sight,
+        with this view's changes made to it."""
+        sight = self.base._sight(coords)
+        if not self.flags:
+            return sight
+        xs, ys = coords
+        x0, y0 = int(xs.min()), int(ys.min())
+        # Which of the visible cells each cell in their box is, if any
+        index = np.empty((xs.max()-x0+1, ys.max()-y0+1), int)
+        index[...] = -1
+        index[xs-x0, ys-y0] = np.arange(len(xs))
+        def visible(xy):
+            i, j = xy[0]-x0, xy[1]-y0
+            return 0 <= i < index.shape[0] and 0 <= j < index.shape[1] and \
+                index[i,j] >= 0
+
+        palette = sight.palette
+        changed = [(xy, t) for (xy, t) in self.terrain_overrides.items()
+                   if visible(xy)]
+        extra = [t for t in set(t for (xy, t) in changed) if t not in palette]
+        if extra:
+            palette = list(palette) + extra
+        terrain = sight.terrain.astype(gamemap.terrain_dtype(len(palette)))
+        if changed:
+            ids = dict((t, i) for (i, t) in enumerate(palette))
+            for xy, t in changed:
+                terrain[index[xy[0]-x0, xy[1]-y0]] = ids[t]
+
+        objects = [(xy, o) for (xy, o) in sight.objects
+                   if xy not in self.contents_overrides]
+        for xy, l in self.contents_overrides.items():
+            if visible(xy):
+                objects.extend((xy, o) for o in l)
+        return gamemap.Sight(coords, terrain, objects, palette)
+
+if __name__=='__main__':
+    import time
+    import util
+    M = gamemap.load_ascii_map(util.data_dir("testmap2.txt"))
+    (xy, door), = list(M.objects.of_kind('doors'))[:1]
+    t = time.time()
+    n = 10000
+    for k in range(n):
+        V = MapView(M)
+        V.set_door_closed(xy, door, not door.closed)
+        assert V.is_passable(xy) == door.closed
+    t = time.time()-t
+    print "%d branches with a door flipped: %g s each" % (n, t/n)
+    print "Base map untouched:", M.is_passable(xy) == (not door.closed)
+
+    # An unchanged view sees what the map sees, cones and all
+    import aibrain
+    import terrain
+    a = aibrain.Actor()
+    for a.coords in zip(*[l.tolist() for l in np.nonzero(M.passable)])[::7]:
+        for a.orientation in range(8):
+            assert MapView(M).look(a) == M.look(a)
+    print "Views see what the map sees"
+
+    # Compact looks show the view's changes too
+    V = MapView(M)
+    V.set_terrain(a.coords, terrain.wall)
+    sight = V.look(a, compact=True)
+    xs, ys = sight.coords
+    i, = np.nonzero((xs == a.coords[0]) & (ys == a.coords[1]))
+    assert sight.palette[sight.terrain[i[0]]] is terrain.wall
+    assert M.terrain(a.coords) is not terrain.wall
+    print "Compact looks at a view show its changes"
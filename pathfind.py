@@ -0,0 +1,789 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#       Copyright 2012 Anne Archibald <peridot.faceted@gmail.com>
+#
+#       This program is free software; you can redistribute it and/or modify
+#       it under the terms of the GNU General Public License as published by
+#       the Free Software Foundation; either version 2 of the License, or
+#       (at your option) any later version.
+#
+#       This program is distributed in the hope that it will be useful,
+#       but WITHOUT ANY WARRANTY; without even the implied warranty of
+#       MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+#       GNU General Public License for more details.
+#
+#       You should have received a copy of the GNU General Public License
+#       along with this program; if not, write to the Free Software
+#       Foundation, Inc., 51 Franklin Street, Fifth Floor, Boston,
+#       MA 02110-1301, USA.
+#
+#
+
+"""Finding paths across a map.
+
+Maps are 8-connected grids: a step along an axis costs 1 and a
+diagonal step sqrt(2). find_path returns the shortest path as a pair
+(path, length), path being a tuple of cells from the start to the
+goal inclusive. When the goal cannot be reached it raises
+NoPathException, whose best_effort is the (path, length) to the cell
+nearest the goal that could be reached.
+
+The search is A* with the octile distance as heuristic, which is exact
+on an empty grid. Its bookkeeping is kept in flat lists indexed by
+cell, and entries in the heap that have been superseded are skipped
+when they come out rather than searched for. Since every step of the
+same kind costs the same, JumpPointSearch can find the same paths
+while putting far fewer cells on the heap; DStarLite keeps a search
+going for a walker whose map keeps changing.
+"""
+
+import heapq
+import math
+
+import numpy as np
+
+class NoPathException(ValueError):
+    def __init__(self, best_effort=None):
+        ValueError.__init__(self, "Path not found")
+        self.best_effort=best_effort
+
+SQRT2 = math.sqrt(2)
+# (dx, dy, cost) for the eight steps
+steps = [(1,0,1.), (0,1,1.), (-1,0,1.), (0,-1,1.),
+         (1,1,SQRT2), (1,-1,SQRT2), (-1,1,SQRT2), (-1,-1,SQRT2)]
+
+def on_grid(size, xy):
+    """Whether the cell xy lies on a grid of the given size."""
+    return 0 <= xy[0] < size[0] and 0 <= xy[1] < size[1]
+
+def octile(dx, dy):
+    """Length of the shortest path over an empty grid by (dx, dy)."""
+    dx, dy = abs(dx), abs(dy)
+    return dx + dy + (SQRT2-2)*min(dx, dy)
+
+class AStar(object):
+    """A* search over a grid.
+
+    passable is either a boolean array saying which cells may be
+    entered, or a function passable(x, y), in which case the size
+    (w, h) of the grid may be given; the function is only asked about
+    cells inside the grid, at most once per search. Without a size the
+    grid has no edges, as for the old gamemap.find_path, and the
+    search keeps its bookkeeping in dictionaries. blocked, if given,
+    is a boolean array of cells that may not be entered either, such
+    as those holding other actors; it does not apply to the goal.
+    expanded counts the cells taken off the heap, over all searches.
+    """
+    def __init__(self, passable, size=None, blocked=None):
+        if not callable(passable):
+            passable = np.asarray(passable, bool)
+            size = passable.shape
+        elif size is None and blocked is not None:
+            size = np.shape(blocked)
+        self.size = size
+        self.passable = passable
+        self.blocked = blocked
+        self.expanded = 0
+
+    def _known(self, goal):
+        # Passability of each cell as far as it is known before
+        # searching: 0 not asked yet, 1 yes, 2 no
+        if callable(self.passable):
+            known = np.zeros(self.size, np.uint8)
+        else:
+            known = np.where(self.passable, 1, 2).astype(np.uint8)
+        if self.blocked is not None:
+            known[np.asarray(self.blocked, bool)] = 2
+            if on_grid(self.size, goal) and not callable(self.passable):
+                known[goal] = 1 if self.passable[goal] else 2
+            elif on_grid(self.size, goal):
+                known[goal] = 0
+        return bytearray(known.tostring())
+
+    def find_path(self, start, goal):
+        if self.size is None:
+            return self._find_path_unbounded(tuple(start), tuple(goal))
+        w, h = self.size
+        n = w*h
+        passable = self.passable
+        gx, gy = goal
+        sx, sy = start
+        s, t = sx*h+sy, gx*h+gy
+        if not on_grid(self.size, goal):
+            # Never reached; the search ends with the nearest cell
+            t = -1
+        # Per cell: cost of the best path so far, the cell it came
+        # from, whether it is finished, and whether it is passable
+        cost = [np.inf]*n
+        parent = [-1]*n
+        done = bytearray(n)
+        known = self._known(goal)
+        offsets = [(dx, dy, dx*h+dy, c) for (dx, dy, c) in steps]
+
+        cost[s] = 0.
+        hs = octile(sx-gx, sy-gy)
+        heap = [(hs, hs, s)]
+        nearest, nearest_cell = np.inf, s
+        while heap:
+            f, r, k = heapq.heappop(heap)
+            if done[k]:
+                continue
+            done[k] = 1
+            self.expanded += 1
+            if k == t:
+                return self._path(parent, k), cost[k]
+            x, y = divmod(k, h)
+            d = math.hypot(x-gx, y-gy)
+            if d < nearest:
+                nearest, nearest_cell = d, k
+            ck = cost[k]
+            for dx, dy, dk, c in offsets:
+                nx, ny = x+dx, y+dy
+                if not (0 <= nx < w and 0 <= ny < h):
+                    continue
+                nk = k+dk
+                l = ck+c
+                if done[nk] or l >= cost[nk]:
+                    continue
+                if not known[nk]:
+                    known[nk] = 1 if passable(nx, ny) else 2
+                if known[nk] == 2:
+                    continue
+                cost[nk] = l
+                parent[nk] = k
+                r = octile(nx-gx, ny-gy)
+                heapq.heappush(heap, (l+r, r, nk))
+        raise NoPathException((self._path(parent, nearest_cell), cost[nearest_cell]))
+
+    def _find_path_unbounded(self, start, goal):
+        # The search above, with cells as keys instead of indices
+        passable = self.passable
+        gx, gy = goal
+        cost = {start: 0.}
+        parent = {start: None}
+        done = set()
+        known = {}
+        hs = octile(start[0]-gx, start[1]-gy)
+        heap = [(hs, hs, start)]
+        nearest, nearest_cell = np.inf, start
+        while heap:
+            f, r, k = heapq.heappop(heap)
+            if k in done:
+                continue
+            done.add(k)
+            self.expanded += 1
+            if k == goal:
+                return self._path_unbounded(parent, k), cost[k]
+            x, y = k
+            d = math.hypot(x-gx, y-gy)
+            if d < nearest:
+                nearest, nearest_cell = d, k
+            ck = cost[k]
+            for dx, dy, c in steps:
+                n = nx, ny = x+dx, y+dy
+                l = ck+c
+                if n in done or l >= cost.get(n, np.inf):
+                    continue
+                if n not in known:
+                    known[n] = passable(nx, ny)
+                if not known[n]:
+                    continue
+                cost[n] = l
+                parent[n] = k
+                r = octile(nx-gx, ny-gy)
+                heapq.heappush(heap, (l+r, r, n))
+        raise NoPathException((self._path_unbounded(parent, nearest_cell),
+                               cost[nearest_cell]))
+
+    def _path_unbounded(self, parent, k):
+        p = []
+        while k is not None:
+            p.append(k)
+            k = parent[k]
+        p.reverse()
+        return tuple(p)
+
+    def _path(self, parent, k):
+        h = self.size[1]
+        p = []
+        while k != -1:
+            p.append(divmod(k, h))
+            k = parent[k]
+        p.reverse()
+        return tuple(p)
+
+class DStarLite(object):
+    """Shortest paths to a fixed goal from a start that moves.
+
+    This is D* Lite (Koenig and Likhachev, 2002): the search runs
+    backwards from the goal, so when the start moves or the map changes
+    only the part of the search that is affected is redone. passable
+    and blocked are as for AStar, but must be arrays; call update when
+    they change. expanded counts the cells whose cost was settled,
+    over all searches.
+    """
+    def __init__(self, passable, goal, blocked=None):
+        passable = np.asarray(passable, bool)
+        self.size = w, h = passable.shape
+        self.goal = tuple(goal)
+        # The goal as a flat index; -1 if it is off the map, when there
+        # is never a path and path gives A*'s best effort
+        self.g = goal[0]*h+goal[1] if on_grid(self.size, goal) else -1
+        self.open = self._open(passable, blocked)
+        self.offsets = [(dx, dy, dx*h+dy, c) for (dx, dy, c) in steps]
+        # Cost to the goal, and the one-step lookahead of it
+        self.cost = [np.inf]*(w*h)
+        self.rhs = [np.inf]*(w*h)
+        self.heap = []
+        # The key each cell is queued under; heap entries that do not
+        # match are stale and skipped
+        self.queued = {}
+        self.km = 0.
+        self.start = None
+        self.expanded = 0
+
+    def _open(self, passable, blocked):
+        # Which cells may be entered, as a flat bytearray
+        o = passable.copy()
+        if blocked is not None:
+            o &= ~np.asarray(blocked, bool)
+            if self.g >= 0:
+                o[self.goal] = passable[self.goal]
+        return bytearray(o.astype(np.uint8).tostring())
+
+    def update(self, passable, blocked=None):
+        """Note new passable and blocked arrays."""
+        new = self._open(np.asarray(passable, bool), blocked)
+        changed = np.nonzero(np.frombuffer(bytes(new), np.uint8) !=
+                             np.frombuffer(bytes(self.open), np.uint8))[0]
+        self.open = new
+        if self.start is None:
+            return
+        # Only the cells that could step into a changed cell are affected
+        for k in changed.tolist():
+            for u in self._neighbours(k):
+                self._update(u)
+
+    def path(self, start):
+        """The shortest path (path, length) from start to the goal.
+
+        Raises NoPathException, with best_effort as for find_path, if
+        there is none."""
+        start = tuple(start)
+        w, h = self.size
+        if self.g < 0:
+            return AStar(self._passable()).find_path(start, self.goal)
+        if self.start is None:
+            self.start = start
+            self.rhs[self.g] = 0.
+            self._queue(self.g)
+        elif start != self.start:
+            self.km += octile(start[0]-self.start[0], start[1]-self.start[1])
+            self.start = start
+        s = start[0]*h+start[1]
+        self._search(s)
+        if self.cost[s] == np.inf:
+            return AStar(self._passable()).find_path(start, self.goal)
+
+        cost, open_, g = self.cost, self.open, self.g
+        p = [start]
+        k = s
+        while k != g:
+            x, y = divmod(k, h)
+            best, step = np.inf, None
+            for dx, dy, dk, c in self.offsets:
+                if 0 <= x+dx < w and 0 <= y+dy < h and open_[k+dk]:
+                    l = c+cost[k+dk]
+                    if l < best:
+                        best, step = l, k+dk
+            k = step
+            p.append(divmod(k, h))
+        return tuple(p), cost[s]
+
+    def _passable(self):
+        # The cells that may be entered, as an array again
+        o = np.frombuffer(bytes(self.open), np.uint8).reshape(self.size)
+        return o.astype(bool)
+
+    def _neighbours(self, k):
+        w, h = self.size
+        x, y = divmod(k, h)
+        return [k+dk for (dx, dy, dk, c) in self.offsets
+                if 0 <= x+dx < w and 0 <= y+dy < h]
+
+    def _key(self, k):
+        m = min(self.cost[k], self.rhs[k])
+        x, y = divmod(k, self.size[1])
+        return m+octile(x-self.start[0], y-self.start[1])+self.km, m
+
+    def _queue(self, k):
+        key = self.queued[k] = self._key(k)
+        heapq.heappush(self.heap, key+(k,))
+
+    def _update(self, u):
+        h = self.size[1]
+        if u != self.g:
+            cost, open_ = self.cost, self.open
+            x, y = divmod(u, h)
+            best = np.inf
+            for dx, dy, dk, c in self.offsets:
+                if 0 <= x+dx < self.size[0] and 0 <= y+dy < h and open_[u+dk]:
+                    l = c+cost[u+dk]
+                    if l < best:
+                        best = l
+            self.rhs[u] = best
+        if self.cost[u] != self.rhs[u]:
+            self._queue(u)
+        else:
+            self.queued.pop(u, None)
+
+    def _search(self, s):
+        heap, queued, cost, rhs = self.heap, self.queued, self.cost, self.rhs
+        while heap:
+            k1, k2, u = heap[0]
+            if queued.get(u) != (k1, k2):
+                heapq.heappop(heap)
+                continue
+            # Keys that should tie may differ by rounding, and the tie
+            # must not end the search early
+            if k1 > self._key(s)[0] + 1e-9 and rhs[s] == cost[s]:
+                break
+            heapq.heappop(heap)
+            del queued[u]
+            key = self._key(u)
+            if (k1, k2) < key:
+                self._queue(u)
+                continue
+            self.expanded += 1
+            if cost[u] > rhs[u]:
+                cost[u] = rhs[u]
+                affected = []
+            else:
+                cost[u] = np.inf
+                affected = [u]
+            # Only cells that can be entered are any use to their neighbours
+            if self.open[u]:
+                affected.extend(self._neighbours(u))
+            for v in affected:
+                self._update(v)
+
+class JumpPointSearch(object):
+    """Jump point search (Harabor and Grastien, 2011) over a grid.
+
+    This finds the same shortest paths as AStar, but on runs of open
+    ground it only stops at cells where a path might have to turn, so
+    far fewer cells go through the heap. passable and blocked are as
+    for AStar, but must be arrays. expanded counts the jump points
+    taken off the heap, over all searches.
+
+    Where straight jumps stop is worked out for the whole grid with
+    numpy when the search is made, and kept as byte strings with the
+    runs of each row and column contiguous; a straight jump is then
+    a single find. Reuse one JumpPointSearch for many searches on the
+    same grid.
+    """
+    def __init__(self, passable, blocked=None):
+        self.passable = np.asarray(passable, bool)
+        self.size = self.passable.shape
+        self.blocked = blocked
+        self.expanded = 0
+        self._grids = {}
+
+    def _grid(self, goal):
+        # The open cells and the straight jump stops for a search to
+        # goal. Only the goal being exempt from blocked can make them
+        # differ between goals.
+        key = None
+        if self.blocked is not None and self.blocked[goal] and self.passable[goal]:
+            key = goal
+        if key not in self._grids:
+            if len(self._grids) > 8:
+                self._grids.clear()
+            self._grids[key] = self._make_grid(key)
+        return self._grids[key]
+
+    def _make_grid(self, goal):
+        w, h = self.size
+        # Padded with a closed border, so jumps need no bounds checks
+        o = np.zeros((w+2, h+2), bool)
+        o[1:-1, 1:-1] = self.passable
+        if self.blocked is not None:
+            o[1:-1, 1:-1] &= ~np.asarray(self.blocked, bool)
+        if goal is not None:
+            o[goal[0]+1, goal[1]+1] = True
+        # A straight jump stops on a closed cell or on a cell with a
+        # forced neighbour: one beside it is closed but the one past
+        # that in the direction of travel is open
+        c = ~o
+        mid = np.s_[1:-1, 1:-1]
+        def stops(ahead_left, left, ahead_right, right):
+            st = np.ones(o.shape, np.uint8)
+            st[mid] = c[mid] | (c[left] & o[ahead_left]) | (c[right] & o[ahead_right])
+            return st
+        yp = stops(np.s_[2:, 2:], np.s_[2:, 1:-1], np.s_[:-2, 2:], np.s_[:-2, 1:-1])
+        ym = stops(np.s_[2:, :-2], np.s_[2:, 1:-1], np.s_[:-2, :-2], np.s_[:-2, 1:-1])
+        xp = stops(np.s_[2:, 2:], np.s_[1:-1, 2:], np.s_[2:, :-2], np.s_[1:-1, :-2])
+        xm = stops(np.s_[:-2, 2:], np.s_[1:-1, 2:], np.s_[:-2, :-2], np.s_[1:-1, :-2])
+        return (bytearray(o.astype(np.uint8).tostring()),
+                yp.tostring(), ym.tostring(), xp.T.tostring(), xm.T.tostring())
+
+    def find_path(self, start, goal):
+        w, h = self.size
+        W, H = w+2, h+2
+        goal = tuple(goal)
+        if not on_grid(self.size, goal):
+            return self._fallback(start, goal)
+        open_, yp, ym, xp, xm = self._grid(goal)
+        gx, gy = goal
+        s, t = (start[0]+1)*H+start[1]+1, (gx+1)*H+gy+1
+        tx, ty = gx+1, gy+1
+        if not open_[t] and s != t:
+            # The jumps may only end on the goal if it can be entered
+            return self._fallback(start, goal)
+
+        def straight(k, dX, dY):
+            # Jump from k by (dX, dY), one of which is 0
+            x, y = divmod(k, H)
+            if dY == 1:
+                j = yp.find('\x01', k+1)
+                if x == tx and k < t <= j:
+                    return t
+            elif dY == -1:
+                j = ym.rfind('\x01', 0, k)
+                if x == tx and j <= t < k:
+                    return t
+            elif dX > 0:
+                j = xp.find('\x01', y*W+x+1) % W * H + y
+                if y == ty and k < t <= j:
+                    return t
+            else:
+                j = xm.rfind('\x01', 0, y*W+x) % W * H + y
+                if y == ty and j <= t < k:
+                    return t
+            return j if open_[j] else -1
+        def diagonal(k, dX, dY):
+            while True:
+                k += dX+dY
+                if not open_[k]:
+                    return -1
+                if k == t:
+                    return k
+                if (not open_[k-dX] and open_[k-dX+dY]) or \
+                   (not open_[k-dY] and open_[k+dX-dY]):
+                    return k
+                if straight(k, dX, 0) != -1 or straight(k, 0, dY) != -1:
+                    return k
+
+        cost = {s: 0.}
+        parent = {s: -1}
+        done = set()
+        hs = octile(start[0]-gx, start[1]-gy)
+        heap = [(hs, hs, s)]
+        while heap:
+            f, r, k = heapq.heappop(heap)
+            if k in done:
+                continue
+            done.add(k)
+            self.expanded += 1
+            if k == t:
+                return self._path(parent, k, H), cost[k]
+            x, y = divmod(k, H)
+            pk = parent[k]
+            if pk == -1:
+                dirs = [(dx*H, dy) for (dx, dy, c) in steps]
+            else:
+                # Only the directions a shortest path through k from
+                # its parent could take
+                px, py = divmod(pk, H)
+                dX, dY = cmp(x, px)*H, cmp(y, py)
+                if dX and dY:
+                    dirs = [(dX, 0), (0, dY), (dX, dY)]
+                    if not open_[k-dX]:
+                        dirs.append((-dX, dY))
+                    if not open_[k-dY]:
+                        dirs.append((dX, -dY))
+                elif dX:
+                    dirs = [(dX, 0)]
+                    if not open_[k+1]:
+                        dirs.append((dX, 1))
+                    if not open_[k-1]:
+                        dirs.append((dX, -1))
+                else:
+                    dirs = [(0, dY)]
+                    if not open_[k+H]:
+                        dirs.append((H, dY))
+                    if not open_[k-H]:
+                        dirs.append((-H, dY))
+            ck = cost[k]
+            for dX, dY in dirs:
+                if dX and dY:
+                    j = diagonal(k, dX, dY)
+                else:
+                    j = straight(k, dX, dY)
+                if j == -1 or j in done:
+                    continue
+                jx, jy = divmod(j, H)
+                l = ck+octile(jx-x, jy-y)
+                if l >= cost.get(j, np.inf):
+                    continue
+                cost[j] = l
+                parent[j] = k
+                r = octile(jx-tx, jy-ty)
+                heapq.heappush(heap, (l+r, r, j))
+        return self._fallback(start, goal)
+
+    def _fallback(self, start, goal):
+        # The goal cannot be reached; let A* find the nearest place
+        return AStar(self.passable, blocked=self.blocked).find_path(start, goal)
+
+    def _path(self, parent, k, H):
+        jumps = []
+        while k != -1:
+            x, y = divmod(k, H)
+            jumps.append((x-1, y-1))
+            k = parent[k]
+        jumps.reverse()
+        # Fill in the straight and diagonal runs between jump points
+        p = [jumps[0]]
+        for x, y in jumps[1:]:
+            px, py = p[-1]
+            dx, dy = cmp(x, px), cmp(y, py)
+            while (px, py) != (x, y):
+                px, py = px+dx, py+dy
+                p.append((px, py))
+        return tuple(p)
+
+# The searches find_path can use, by name
+algorithms = {'astar': AStar, 'jps': JumpPointSearch}
+
+def find_path(x1y1, x2y2, passable, size=None, blocked=None, algorithm='astar'):
+    """Shortest path from x1y1 to x2y2.
+
+    passable is a boolean array of the cells that may be entered, or a
+    function passable(x, y) over a grid of the given size, or with no
+    edges if size is None; cells outside the grid never may be, nor
+    may those in the array blocked other than x2y2. algorithm names one of algorithms; 'jps' is
+    usually much faster on open ground, but needs passable to be an
+    array. Returns (path, length); raises NoPathException if there is
+    none."""
+    if algorithm == 'astar':
+        return AStar(passable, size, blocked).find_path(x1y1, x2y2)
+    return algorithms[algorithm](passable, blocked).find_path(x1y1, x2y2)
+
+def reference_find_path(x1y1,x2y2,passable):
+    """The search find_path replaced, kept to compare against.
+
+    Its heuristic is the distance back to the start, so it looks at
+    most of what it can reach, and its paths are not always the
+    shortest."""
+
+    def dist(x1y1, x2y2):
+        x1,y1 = x1y1
+        x2,y2 = x2y2
+        return np.hypot(x1-x2,y1-y2)
+
+    path_to = {x1y1: ((x1y1,),0)}
+    costs = [(dist(x1y1,x2y2), x1y1)]
+
+    closest = np.inf, None
+
+    while costs:
+        d, node = heapq.heappop(costs)
+        if node == x2y2:
+            return path_to[x2y2]
+
+        dd = dist(node,x2y2)
+        if dd < closest[0]:
+            closest = dd, node
+
+        path_so_far, l_so_far = path_to[node]
+
+        nx, ny = node
+        #FIXME: make pathfinding more random
+        for i in (-1,0,1):
+            for j in (-1,0,1):
+                nbx, nby = nx+i, ny+j
+                if not passable(nbx,nby):
+                    continue
+                l = l_so_far + np.hypot(i,j)
+                if (nbx,nby) in path_to:
+                    pp, ll = path_to[nbx,nby]
+                    if ll<=l:
+                        continue
+                    # new shortest path to this node
+                    # so remove it from the queue (if it's there)
+                    # and fall through to the "new node" code
+                    costs = [(d,n) for (d,n) in costs if n!=(nbx,nby)]
+                # this is the shortest known path to (nbx,nby)
+                path_to[nbx,nby] = path_so_far + ((nbx,nby),), l
+
+                # How promising is it?
+                cost = l+dist((nbx,nby),x1y1)
+
+                heapq.heappush(costs, (cost,(nbx,nby)))
+
+    raise NoPathException(path_to[closest[1]])
+
+if __name__=='__main__':
+    import time
+    import random
+    import util
+    import gamemap
+
+    def arena(n, density, seed=0):
+        passable = np.random.RandomState(seed).rand(n, n) >= density
+        passable[[0,-1],:] = passable[:,[0,-1]] = False
+        return passable
+    maps = [(f, gamemap.load_ascii_map(util.data_dir(f)).passable)
+            for f in ["testmap1.txt", "testmap2.txt"]]
+    maps += [("open arena 60x60", arena(60, 0.)),
+             ("pillars 60x60", arena(60, 0.1)),
+             ("rubble 60x60", arena(60, 0.3))]
+
+    random.seed(0)
+    for name, passable in maps:
+        cells = zip(*[a.tolist() for a in np.nonzero(passable)])
+        pairs = [(random.choice(cells), random.choice(cells)) for k in range(30)]
+        calls = [0]
+        def counted(x, y):
+            calls[0] += 1
+            return passable[x, y]
+        old_lengths, new_lengths = [], []
+        found = []
+
+        t = time.time()
+        for a, b in pairs:
+            try:
+                p, l = reference_find_path(a, b, counted)
+                found.append(True)
+            except NoPathException, e:
+                p, l = e.best_effort
+                found.append(False)
+            old_lengths.append(l)
+        told = time.time() - t
+        # Every cell the old search takes off the heap, apart from the
+        # goal, has its 9 neighbours (itself included) looked at
+        old_expanded = calls[0]//9
+
+        A = AStar(lambda x, y: passable[x, y], passable.shape)
+        t = time.time()
+        for a, b in pairs:
+            try:
+                p, l = A.find_path(a, b)
+            except NoPathException, e:
+                p, l = e.best_effort
+            assert p[0] == a and all(passable[c] for c in p[1:])
+            new_lengths.append(l)
+        tnew = time.time() - t
+
+        B = AStar(passable)
+        t = time.time()
+        for (a, b), l in zip(pairs, new_lengths):
+            try:
+                p, m = B.find_path(a, b)
+            except NoPathException, e:
+                p, m = e.best_effort
+            assert m == l
+        tarray = time.time() - t
+
+        compared = [(n, o) for (n, o, f) in zip(new_lengths, old_lengths, found) if f]
+        shorter = sum(n < o - 1e-9 for (n, o) in compared)
+        assert all(n <= o + 1e-9 for (n, o) in compared)
+        print "%s, %d searches:" % (name, len(pairs))
+        print "  find_path (old)  %7d cells expanded, %7.2f ms per search" % \
+            (old_expanded, 1000*told/len(pairs))
+        print "  AStar            %7d cells expanded, %7.2f ms per search, %d paths shorter" % \
+            (A.expanded, 1000*tnew/len(pairs), shorter)
+        print "  AStar on array   %7d cells expanded, %7.2f ms per search" % \
+            (B.expanded, 1000*tarray/len(pairs))
+
+    # Walking a long way while the map changes under the walker
+    passable = arena(60, 0.2, seed=1)
+    cells = zip(*[a.tolist() for a in np.nonzero(passable)])
+    start, goal = min(cells), max(cells)
+    A = AStar(passable)
+    D = DStarLite(passable, goal)
+    tfull = trepair = 0.
+    walked = 0
+    here = start
+    while here != goal:
+        t = time.time()
+        p, l = A.find_path(here, goal)
+        tfull += time.time() - t
+        t = time.time()
+        q, m = D.path(here)
+        trepair += time.time() - t
+        assert abs(l - m) < 1e-9
+        here = q[1]
+        walked += 1
+        if walked % 10 == 0 and len(q) > 5:
+            # Something moves into the way a few steps ahead
+            passable[q[4]] = False
+            D.update(passable)
+            A = AStar(passable)
+    print "walk of %d steps on rubble 60x60, blocked every 10 steps:" % walked
+    print "  AStar every step  %7.2f ms per step" % (1000*tfull/walked)
+    print "  DStarLite         %7.2f ms per step, %d cells expanded in all" % \
+        (1000*trepair/walked, D.expanded)
+
+    # The old call, with a function and no size, still works, as if
+    # the grid had no edges
+    for name, passable in maps:
+        w, h = passable.shape
+        inside = lambda x, y: 0 <= x < w and 0 <= y < h and passable[x, y]
+        cells = zip(*[a.tolist() for a in np.nonzero(passable)])
+        for k in range(10):
+            a, b = random.choice(cells), random.choice(cells)
+            try:
+                l = find_path(a, b, passable)[1]
+            except NoPathException, e:
+                l = None
+            try:
+                m = gamemap.find_path(a, b, inside)[1]
+            except gamemap.NoPathException, e:
+                m = None
+            assert l == m or abs(l - m) < 1e-9
+    assert gamemap.find_path((1,1), (5,5), lambda x, y: True)[1] == 4*SQRT2
+
+    # Jump point search agrees with A*, also on goals that are walls
+    # or off the map
+    for name, passable in maps:
+        w, h = passable.shape
+        cells = zip(*[a.tolist() for a in np.nonzero(passable)])
+        for k in range(30):
+            a = random.choice(cells)
+            b = random.randrange(-2, w+2), random.randrange(-2, h+2)
+            found = []
+            for alg in ['astar', 'jps']:
+                try:
+                    found.append(algorithms[alg](passable).find_path(a, b))
+                except NoPathException, e:
+                    found.append(e.best_effort)
+            (p, l), (q, m) = found
+            assert abs(l - m) < 1e-9 and p[-1] == q[-1]
+            assert all(passable[c] for c in q)
+
+    # Jump point search against A*
+    maps.append(("open arena 200x200", arena(200, 0.)))
+    for name, passable in maps:
+        cells = zip(*[a.tolist() for a in np.nonzero(passable)])
+        pairs = [(random.choice(cells), random.choice(cells)) for k in range(30)]
+        results = {}
+        for alg in ['astar', 'jps']:
+            S = algorithms[alg](passable)
+            t = time.time()
+            lengths = []
+            for a, b in pairs:
+                try:
+                    lengths.append(S.find_path(a, b)[1])
+                except NoPathException:
+                    lengths.append(None)
+            results[alg] = lengths, S.expanded, time.time() - t
+        for l, m in zip(results['astar'][0], results['jps'][0]):
+            assert l == m or abs(l - m) < 1e-9
+        print "%s, %d searches:" % (name, len(pairs))
+        for alg in ['astar', 'jps']:
+            lengths, expanded, elapsed = results[alg]
+            print "  %-6s %7d cells expanded, %7.2f ms per search" % \
+                (alg, expanded, 1000*elapsed/len(pairs))
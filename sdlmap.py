@@ -28,7 +28,6 @@ from pygame import Rect
 import util
 import gamemap
 import image
-import terrain
 
 
 class SDLMap(object):
@@ -83,14 +82,9 @@ class SDLMap(object):
         i = (x+2*y+32)//64
         j = (2*y-x+32)//64
         return (i,j)
-    def see(self, things):
-        for coords, obj in things:
-            if isinstance(obj, terrain.Terrain):
-                self.map_to_draw.set_terrain(coords, obj)
-                del self.map_to_draw.objects[coords][:]
-        for coords, obj in things:
-            if not isinstance(obj, terrain.Terrain):
-                self.map_to_draw.objects[coords].append(obj)
+    def see(self, sight):
+        """Add a gamemap.Sight to the map drawn, a mapmemory.MapMemory."""
+        self.map_to_draw.see(sight)
 
 if __name__ == '__main__':
     import sys
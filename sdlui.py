@@ -30,6 +30,7 @@ import util
 import ui
 import game
 import gamemap
+import mapmemory
 import sdlmap
 import command
 import action
@@ -80,7 +81,7 @@ class MapLayer(Layer):
         self.screen = None
     def draw(self, screen):
         self.screen = screen
-        self.sdlmap.see(self.gamemap.look(self.ui.gameboard.PC))
+        self.sdlmap.see(self.gamemap.look(self.ui.gameboard.PC, compact=True))
         i, j = self.ui.gameboard.PC.coords
         self.sdlmap.view_x = 32*i-32*j
         self.sdlmap.view_y = 16*i+16*j
@@ -164,10 +165,10 @@ class SDLUI(ui.UI):
         gb.gamemap = gamemap.load_ascii_map(util.data_dir("testmap2.txt"))
         gb.PC = game.PC()
         gb.PC.coords = (10,5)
-        gb.gamemap.objects[gb.PC.coords].append(gb.PC)
+        gb.gamemap.add_object(gb.PC.coords, gb.PC)
         ui.UI.new_game(self, gb)
         
-        self.layers = [MapLayer(gamemap.Map(gb.gamemap.size), gb.gamemap, self), HUDLayer(gb,self)]
+        self.layers = [MapLayer(mapmemory.MapMemory(gb.gamemap.size), gb.gamemap, self), HUDLayer(gb,self)]
         
     def event_loop(self):
         while True: